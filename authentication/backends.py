@@ -0,0 +1,25 @@
+"""Authentication classes for the API"""
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.settings import api_settings
+
+from . import tokens
+from .models import User
+
+
+class ClaimsJWTAuthentication(JWTAuthentication):
+    """JWT authentication which trusts the role claim of current tokens
+
+    The user is built from the token instead of being loaded, so it only
+    has an id and a role. Tokens issued before the user's role or ban
+    status changed, and tokens without the claims, fall back to loading
+    the user from the database.
+    """
+
+    def get_user(self, validated_token):
+        if not tokens.is_current(validated_token):
+            user = super().get_user(validated_token)
+            tokens.remember_version(user, replace=False)
+            return user
+        return User(id=validated_token[api_settings.USER_ID_CLAIM],
+                    role_id=validated_token[tokens.ROLE_CLAIM],
+                    token_version=validated_token[tokens.VERSION_CLAIM])
@@ -0,0 +1,36 @@
+"""Deletes expired tokens from the token blacklist tables"""
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+from rest_framework_simplejwt.token_blacklist.models import (BlacklistedToken,
+                                                             OutstandingToken)
+
+from authentication import revocation
+
+
+class Command(BaseCommand):
+    help = (
+        "Deletes outstanding and blacklisted tokens which have expired. "
+        "Expired tokens are rejected anyway, so the rows are only dead "
+        "weight. Meant to be run periodically, e.g. daily from cron."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=5000)
+
+    def handle(self, *args, **options):
+        now = timezone.now()
+        expired = OutstandingToken.objects.filter(
+            expires_at__lte=now).order_by("id")
+        deleted = 0
+        last_id = 0
+        # short transactions keep the tables available for logins
+        while ids := list(expired.filter(id__gt=last_id).values_list(
+                "id", flat=True)[:options["batch_size"]]):
+            with transaction.atomic():
+                BlacklistedToken.objects.filter(token_id__in=ids).delete()
+                OutstandingToken.objects.filter(id__in=ids).delete()
+            deleted += len(ids)
+            last_id = ids[-1]
+        revocation.reset()
+        self.stdout.write(self.style.SUCCESS(f"{deleted} expired tokens deleted"))
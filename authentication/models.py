@@ -5,12 +5,31 @@ from django.contrib.auth.models import AbstractBaseUser, BaseUserManager
 from django.db import models
 
 
+class RoleManager(models.Manager):
+    """Keeps every role in memory, the table is tiny and rarely changes"""
+
+    _cache = None
+
+    def get_cached(self, pk):
+        """Returns a role without a query once the roles are loaded"""
+        roles = RoleManager._cache
+        if roles is None:
+            roles = RoleManager._cache = {role.pk: role for role in self.all()}
+        return roles[pk]
+
+    def clear_cache(self):
+        """Called whenever a role changes, see signals.py"""
+        RoleManager._cache = None
+
+
 class Role(models.Model):
     """Represents user roles (user, moderator, admin)"""
 
     name = models.CharField(max_length=45)
     title = models.CharField(max_length=45)
 
+    objects = RoleManager()
+
     def __str__(self):
         return f"Role {self.pk}: {self.name} ({self.title})"
 
@@ -34,14 +53,14 @@ class UserManager(BaseUserManager):
 
         user = self.model(username=username, email=self.normalize_email(email))
         user.set_password(password)
-        user.role = Role.objects.get(pk=Roles.USER)
+        user.role = Role.objects.get_cached(Roles.USER)
         user.save()
 
         return user
 
     def create_superuser(self, username, email, password):
         user = self.create_user(username, email, password)
-        user.role = Role.objects.get(pk=Roles.ADMIN)
+        user.role = Role.objects.get_cached(Roles.ADMIN)
         user.save()
 
         return user
@@ -55,12 +74,32 @@ class User(AbstractBaseUser):
     created_at = models.DateTimeField(auto_now_add=True)
     blocked_until = models.DateTimeField(blank=True, null=True, default=None)
     role = models.ForeignKey(Role, default=Roles.USER, on_delete=models.PROTECT)
+    # bumped whenever data carried by access tokens changes, see tokens.py
+    token_version = models.PositiveIntegerField(default=0)
 
     USERNAME_FIELD = "email"
     REQUIRED_FIELDS = ["username", "password"]
+    TOKEN_FIELDS = ["role_id", "blocked_until"]
 
     objects = UserManager()
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        user = super().from_db(db, field_names, values)
+        user._loaded_token_data = user._token_data()
+        return user
+
+    def _token_data(self):
+        # deferred fields are not loaded, they cannot have changed
+        return [self.__dict__.get(field) for field in self.TOKEN_FIELDS]
+
+    def save(self, *args, **kwargs):
+        loaded = getattr(self, "_loaded_token_data", None)
+        if loaded is not None and loaded != self._token_data():
+            self.token_version += 1
+        super().save(*args, **kwargs)
+        self._loaded_token_data = self._token_data()
+
     @property
     def has_perm(self):
         return lambda _: self.is_superuser
@@ -75,11 +114,11 @@ class User(AbstractBaseUser):
 
     @property
     def is_superuser(self):
-        return self.role == Role.objects.get(pk=Roles.ADMIN)
+        return self.role_id == Roles.ADMIN
 
     @property
     def is_moderator(self):
-        return self.role == Role.objects.get(pk=Roles.MODERATOR)
+        return self.role_id == Roles.MODERATOR
 
     def get_full_name(self):
         return self.username
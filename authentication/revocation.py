@@ -0,0 +1,161 @@
+"""In-memory filter of revoked refresh tokens
+
+Every refresh and logout checks that the token is not blacklisted. Almost
+none are, so the ids of blacklisted tokens are kept in a bloom filter and
+the blacklist table is only probed for ids the filter might contain.
+
+The filter is loaded once per process and then extended with the rows
+blacklisted since. Blacklisting increments a counter in the cache, so a
+process only queries when a token has been blacklisted, or periodically.
+Compaction replaces a generation in the cache, which rebuilds the
+filters.
+
+The counter and the generation must reach every process, so the filter is
+only used with a shared cache, or a per-process one with a single worker.
+Otherwise the blacklist is always probed.
+"""
+import math
+import threading
+import time
+from hashlib import blake2b
+
+from django.core.cache import cache
+from django.db import transaction
+from django.utils import timezone
+from rest_framework_simplejwt.token_blacklist.models import BlacklistedToken
+
+from caketruth import caches
+
+CHANGES_KEY = "auth:revoked:changes"
+GENERATION_KEY = "auth:revoked:generation"
+
+
+class BloomFilter:
+    """Set of strings with false positives at `error_rate`, never negatives"""
+
+    def __init__(self, capacity, error_rate=0.001):
+        self.capacity = capacity
+        self.size = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, key):
+        digest = blake2b(key.encode(), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], "little")
+        second = int.from_bytes(digest[8:], "little") | 1
+        return [(first + i * second) % self.size for i in range(self.hashes)]
+
+    def add(self, key):
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        return all(self.bits[position >> 3] & 1 << (position & 7)
+                   for position in self._positions(key))
+
+
+class RevocationFilter:
+    """Bloom filter of blacklisted token ids kept in sync with the table
+
+    Checks only read the counter and the generation from the cache. The
+    table is read when one of them changed, and every `reload_seconds`
+    in case an increment was lost between a commit and the cache.
+    """
+    min_capacity = 1024
+    # rows are read by id, so an insert committed after a newer one would
+    # be missed. Rereading the last few ids covers such transactions.
+    sync_overlap = 100
+    reload_seconds = 60
+
+    def __init__(self):
+        self._loading = threading.Lock()
+        self._filter = None
+        self._state = None
+        self._loaded_at = None
+        self._last_id = 0
+
+    def might_be_revoked(self, jti):
+        if not caches.is_shared():
+            return True
+        state = _shared_state()
+        if state != self._state or self._is_due():
+            self._reload(state)
+        return jti in self._filter
+
+    def _reload(self, state):
+        # checks wait for a reload, so none is answered by a filter which
+        # misses a revocation the state announced
+        with self._loading:
+            if state == self._state and not self._is_due():
+                return  # reloaded by another thread
+            if self._filter is None or state[0] != self._state[0]:
+                self._rebuild()
+            else:
+                self._load(self._last_id - self.sync_overlap)
+            self._state = state
+            self._loaded_at = time.monotonic()
+
+    def _is_due(self):
+        return time.monotonic() - self._loaded_at >= self.reload_seconds
+
+    def _rebuild(self):
+        alive = BlacklistedToken.objects.filter(
+            token__expires_at__gt=timezone.now())
+        bloom = BloomFilter(max(self.min_capacity, 2 * alive.count()))
+        last_id = self._add(bloom, alive, 0)
+        # swapped in complete, checks keep using the previous filter
+        self._filter, self._last_id = bloom, last_id
+
+    def _load(self, after_id):
+        self._last_id = max(self._last_id, self._add(
+            self._filter, BlacklistedToken.objects.all(), after_id))
+        if self._filter.count > self._filter.capacity:
+            self._rebuild()
+
+    @staticmethod
+    def _add(bloom, queryset, after_id):
+        """Adds the ids of the rows after `after_id`, returns the last id"""
+        last_id = after_id
+        rows = queryset.filter(id__gt=after_id).values_list("id", "token__jti")
+        for pk, jti in rows.iterator():
+            bloom.add(jti)
+            last_id = max(last_id, pk)
+        return last_id
+
+
+def _shared_state():
+    """(generation, changes) as stored in the cache, evicted keys come
+    back with new values and force a reload"""
+    keys = [GENERATION_KEY, CHANGES_KEY]
+    state = cache.get_many(keys)
+    for key in keys:
+        if key not in state:
+            cache.add(key, time.time_ns(), timeout=None)
+            state[key] = cache.get(key)
+    return state[GENERATION_KEY], state[CHANGES_KEY]
+
+
+revocations = RevocationFilter()
+
+
+def might_be_revoked(jti):
+    return revocations.might_be_revoked(jti)
+
+
+def token_blacklisted():
+    """Lets every process know that a token has been blacklisted"""
+    transaction.on_commit(_count_change)
+
+
+def _count_change():
+    try:
+        cache.incr(CHANGES_KEY)
+    except ValueError:
+        pass  # the key is missing, readers will reload anyway
+
+
+def reset():
+    """Makes every process rebuild its filter, e.g. after compaction"""
+    cache.set(GENERATION_KEY, time.time_ns(), timeout=None)
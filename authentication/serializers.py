@@ -1,5 +1,9 @@
 from rest_framework import serializers
+from rest_framework_simplejwt import serializers as jwt_serializers
+from rest_framework_simplejwt.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.settings import api_settings
 
+from . import tokens
 from .models import Role, Roles, User
 
 
@@ -11,11 +15,14 @@ class RoleSerializer(serializers.ModelSerializer):
         fields = ["name", "title"]
         read_only_fields = ["name", "title"]
 
+    def get_attribute(self, instance):
+        return Role.objects.get_cached(instance.role_id)
+
 
 class UserSerializer(serializers.ModelSerializer):
     """Serializer for regular users"""
     password_confirm = serializers.CharField(write_only=True)
-    role = RoleSerializer(default=Role.objects.get(id=Roles.USER))
+    role = RoleSerializer(default=lambda: Role.objects.get_cached(Roles.USER))
 
     class Meta:
         """Users can view their data but cannot ban or change roles"""
@@ -84,7 +91,8 @@ class AdminSerializer(ModeratorSerializer):
 
     def to_representation(self, instance):
         response = super().to_representation(instance)
-        response["role"] = RoleSerializer(instance.role).data
+        response["role"] = RoleSerializer(
+            Role.objects.get_cached(instance.role_id)).data
         return response
 
 
@@ -94,3 +102,33 @@ def select_serializer(role):
     elif role == Roles.MODERATOR:
         return ModeratorSerializer
     return UserSerializer
+
+
+class TokenObtainPairSerializer(jwt_serializers.TokenObtainPairSerializer):
+    """Issues tokens with the role and token version claims"""
+    token_class = tokens.RefreshToken
+
+    @classmethod
+    def get_token(cls, user):
+        tokens.remember_version(user, replace=False)
+        return tokens.add_claims(super().get_token(user), user)
+
+
+class TokenRefreshSerializer(jwt_serializers.TokenRefreshSerializer):
+    """Reads the claims from the database before issuing an access token"""
+    token_class = tokens.RefreshToken
+
+    def validate(self, attrs):
+        refresh = self.token_class(attrs["refresh"])
+        user = User.objects.filter(
+            **{api_settings.USER_ID_FIELD: refresh[api_settings.USER_ID_CLAIM]}
+        ).first()
+        if user is None:
+            raise AuthenticationFailed("User not found", code="user_not_found")
+        tokens.remember_version(user, replace=False)
+        attrs["refresh"] = str(tokens.add_claims(refresh, user))
+        return super().validate(attrs)
+
+
+class TokenBlacklistSerializer(jwt_serializers.TokenBlacklistSerializer):
+    token_class = tokens.RefreshToken
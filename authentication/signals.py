@@ -0,0 +1,28 @@
+"""Signal handlers of the authentication app"""
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from rest_framework_simplejwt.token_blacklist.models import BlacklistedToken
+
+from . import revocation, tokens
+from .models import Role, User
+
+
+@receiver([post_save, post_delete], sender=Role)
+def clear_role_cache(**kwargs):
+    Role.objects.clear_cache()
+
+
+@receiver(post_save, sender=User)
+def remember_token_version(instance, **kwargs):
+    tokens.remember_version(instance)
+
+
+@receiver(post_delete, sender=User)
+def forget_token_version(instance, **kwargs):
+    tokens.forget_version(instance.pk)
+
+
+@receiver(post_save, sender=BlacklistedToken)
+def count_blacklisted_token(created, **kwargs):
+    if created:
+        revocation.token_blacklisted()
@@ -1,3 +1,233 @@
-from django.test import TestCase
+import tempfile
+from datetime import timedelta
+from io import StringIO
 
-# Create your tests here.
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.token_blacklist.models import (BlacklistedToken,
+                                                             OutstandingToken)
+
+from .models import Role, Roles, User
+from .revocation import BloomFilter, RevocationFilter
+
+DEFAULT_CACHES = settings.CACHES
+# a cache which separate processes share, unlike the default LocMemCache
+SHARED_CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
+        "LOCATION": f"{tempfile.gettempdir()}/caketruth-tests",
+    }
+}
+
+
+class RoleCacheTest(TestCase):
+    fixtures = ["roles"]
+
+    def test_role_checks_do_not_query(self):
+        user = User.objects.create_user("user", "user@example.com", "pass")
+        user = User.objects.get(pk=user.pk)
+        with self.assertNumQueries(0):
+            self.assertFalse(user.is_superuser)
+            self.assertFalse(user.is_moderator)
+            self.assertEqual(Role.objects.get_cached(Roles.USER).name, "user")
+
+    def test_cache_is_cleared_on_change(self):
+        role = Role.objects.get_cached(Roles.MODERATOR)
+        role.title = "Moderator"
+        role.save()
+        self.assertEqual(
+            Role.objects.get_cached(Roles.MODERATOR).title, "Moderator")
+
+
+@override_settings(CACHES=SHARED_CACHES)
+class ClaimsAuthenticationTest(TestCase):
+    fixtures = ["roles"]
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user("user", "user@example.com", "pass")
+        self.client = APIClient()
+
+    def _login(self):
+        tokens = self.client.post("/api/users/login/", {
+            "email": "user@example.com", "password": "pass"}).json()
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {tokens['access']}")
+        return tokens
+
+    def test_current_token_needs_no_user_lookup(self):
+        self._login()
+        self.client.get("/api/product-categories/")
+        with self.assertNumQueries(0):
+            response = self.client.get("/api/product-categories/")
+        self.assertEqual(response.status_code, 200)
+
+    def test_role_change_makes_token_stale(self):
+        tokens = self._login()
+        response = self.client.post("/api/product-categories/", {"title": "Dairy"})
+        self.assertEqual(response.status_code, 403)
+
+        user = User.objects.get(pk=self.user.pk)
+        user.role_id = Roles.MODERATOR
+        with self.captureOnCommitCallbacks(execute=True):
+            user.save()
+        response = self.client.post("/api/product-categories/", {"title": "Dairy"})
+        self.assertEqual(response.status_code, 201)
+
+        self.client.credentials()
+        access = self.client.post("/api/users/login/refresh/", {
+            "refresh": tokens["refresh"]}).json()["access"]
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {access}")
+        self.client.get("/api/product-categories/")
+        with self.assertNumQueries(0):
+            self.client.get("/api/product-categories/")
+
+    def test_deleted_users_are_rejected(self):
+        self._login()
+        self.client.get("/api/product-categories/")
+        with self.captureOnCommitCallbacks(execute=True):
+            User.objects.get(pk=self.user.pk).delete()
+        self.assertEqual(
+            self.client.get("/api/product-categories/").status_code, 401)
+
+    def test_readers_replace_older_versions(self):
+        self._login()
+        # a version left by a reader which loaded the user before a write
+        cache.set(f"auth:token-version:{self.user.pk}", -1, timeout=None)
+        self.client.get("/api/product-categories/")
+        with self.assertNumQueries(0):
+            self.client.get("/api/product-categories/")
+
+    def test_per_process_cache_loads_the_user(self):
+        self._login()
+        self.client.get("/api/product-categories/")
+        with self.settings(CACHES=DEFAULT_CACHES, WORKERS=2), \
+                CaptureQueriesContext(connection) as queries:
+            self.client.get("/api/product-categories/")
+        self.assertTrue([q for q in queries
+                         if "authentication_user" in q["sql"]])
+
+
+class TokenRevocationTest(TestCase):
+    fixtures = ["roles"]
+
+    def setUp(self):
+        cache.clear()
+        User.objects.create_user("user", "user@example.com", "pass")
+        self.client = APIClient()
+
+    def _refresh(self, refresh):
+        return self.client.post("/api/users/login/refresh/", {"refresh": refresh})
+
+    def _login(self):
+        return self.client.post("/api/users/login/", {
+            "email": "user@example.com", "password": "pass"}).json()["refresh"]
+
+    def test_refresh_skips_blacklist_probe(self):
+        refresh = self._login()
+        self._refresh(refresh)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self._refresh(refresh).status_code, 200)
+        self.assertFalse([q for q in queries
+                          if "token_blacklist_blacklistedtoken" in q["sql"]])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post("/api/users/logout/", {"refresh": refresh})
+        self.assertEqual(self._refresh(refresh).status_code, 401)
+
+    @override_settings(WORKERS=2)
+    def test_processes_without_shared_cache_probe(self):
+        first, second = RevocationFilter(), RevocationFilter()
+        token = OutstandingToken.objects.create(
+            jti="revoked", token="", expires_at=timezone.now() + timedelta(days=1))
+        self.assertTrue(first.might_be_revoked("other"))
+        BlacklistedToken.objects.create(token=token)
+        self.assertTrue(second.might_be_revoked("revoked"))
+        self.assertTrue(first.might_be_revoked("revoked"))
+
+    @override_settings(CACHES=SHARED_CACHES, WORKERS=2)
+    def test_filters_follow_the_shared_cache(self):
+        cache.clear()
+        first, second = RevocationFilter(), RevocationFilter()
+        tokens = [OutstandingToken.objects.create(
+            jti=f"revoked-{i}", token="",
+            expires_at=timezone.now() + timedelta(days=1)) for i in range(2)]
+        self.assertFalse(first.might_be_revoked("revoked-0"))
+        self.assertFalse(second.might_be_revoked("revoked-0"))
+        with self.captureOnCommitCallbacks(execute=True):
+            BlacklistedToken.objects.create(token=tokens[0])
+        with self.assertNumQueries(1):
+            self.assertTrue(first.might_be_revoked("revoked-0"))
+        with self.assertNumQueries(0):
+            self.assertFalse(first.might_be_revoked("other"))
+        self.assertTrue(second.might_be_revoked("revoked-0"))
+
+        # an increment lost on the way is caught by the periodic reload
+        BlacklistedToken.objects.create(token=tokens[1])
+        self.assertFalse(first.might_be_revoked("revoked-1"))
+        first.reload_seconds = second.reload_seconds = 0
+        self.assertTrue(first.might_be_revoked("revoked-1"))
+
+    def test_compaction_deletes_expired_tokens(self):
+        past = timezone.now() - timedelta(days=1)
+        for i in range(5):
+            token = OutstandingToken.objects.create(
+                jti=f"expired-{i}", token="", expires_at=past)
+            BlacklistedToken.objects.create(token=token)
+        OutstandingToken.objects.create(
+            jti="alive", token="", expires_at=timezone.now() + timedelta(days=1))
+        call_command("compact_tokens", batch_size=2, stdout=StringIO())
+        self.assertEqual(
+            list(OutstandingToken.objects.values_list("jti", flat=True)),
+            ["alive"])
+        self.assertFalse(BlacklistedToken.objects.exists())
+
+
+class BloomFilterTest(SimpleTestCase):
+    def test_members_are_always_found(self):
+        bloom = BloomFilter(1000)
+        for i in range(1000):
+            bloom.add(f"token-{i}")
+        self.assertTrue(all(f"token-{i}" in bloom for i in range(1000)))
+        false_positives = sum(f"other-{i}" in bloom for i in range(10000))
+        self.assertLess(false_positives, 100)
+
+
+class QueryBudgetTest(TestCase):
+    """Maximum number of queries of every action, see core.tests"""
+    fixtures = ["roles"]
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user("user", "user@example.com", "pass")
+        Role.objects.get_cached(Roles.USER)
+        self.client = APIClient()
+
+    def assertBudget(self, budget, method, path, body=None):
+        with CaptureQueriesContext(connection) as queries:
+            response = getattr(self.client, method)(path, body, format="json")
+        self.assertLess(response.status_code, 300, f"{method} {path}")
+        self.assertLessEqual(len(queries), budget,
+                             f"{method.upper()} {path} over budget")
+        return response
+
+    def test_users(self):
+        self.assertBudget(3, "post", "/api/users/", {
+            "email": "new@example.com", "username": "new", "password": "pass",
+            "password_confirm": "pass"})
+        self.client.force_authenticate(self.user)
+        self.assertBudget(1, "get", f"/api/users/{self.user.id}/")
+        self.assertBudget(3, "patch", f"/api/users/{self.user.id}/",
+                          {"username": "renamed"})
+
+    def test_tokens(self):
+        refresh = self.assertBudget(2, "post", "/api/users/login/", {
+            "email": "user@example.com", "password": "pass"}).json()["refresh"]
+        self.assertBudget(3, "post", "/api/users/login/refresh/",
+                          {"refresh": refresh})
+        self.assertBudget(5, "post", "/api/users/logout/", {"refresh": refresh})
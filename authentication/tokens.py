@@ -0,0 +1,77 @@
+"""User data carried by access tokens
+
+Access tokens include the role of the user and the user's token version.
+The current version of every user is remembered in the cache, and while
+the token's version matches it, requests are authenticated from the
+claims alone, see backends.py.
+
+New versions must reach every process, so the claims are only trusted
+with a shared cache, or a per-process one such as the default LocMemCache
+with a single worker. Otherwise the user is always loaded.
+"""
+from django.core.cache import cache
+from django.db import transaction
+from rest_framework_simplejwt import tokens as jwt_tokens
+from rest_framework_simplejwt.settings import api_settings
+
+from caketruth import caches
+
+from . import revocation
+
+ROLE_CLAIM = "role"
+VERSION_CLAIM = "ver"
+
+
+def _version_key(user_id):
+    return f"auth:token-version:{user_id}"
+
+
+def add_claims(token, user):
+    token[ROLE_CLAIM] = user.role_id
+    token[VERSION_CLAIM] = user.token_version
+    return token
+
+
+def is_current(token):
+    """Tells whether the claims of the token still describe the user"""
+    if not caches.is_shared():
+        return False
+    if ROLE_CLAIM not in token or VERSION_CLAIM not in token:
+        return False
+    version = cache.get(_version_key(token[api_settings.USER_ID_CLAIM]))
+    return version == token[VERSION_CLAIM]
+
+
+def remember_version(user, replace=True):
+    """Stores the token version of a user
+
+    Writers replace the version once their transaction is committed.
+    Readers fill in a missing version and replace an older one, as
+    versions only grow a version read before a write cannot overwrite the
+    newer one.
+    """
+    key = _version_key(user.pk)
+    version = user.token_version
+    if replace:
+        transaction.on_commit(
+            lambda: cache.set(key, version, timeout=None))
+    elif not cache.add(key, version, timeout=None):
+        cached = cache.get(key)
+        if cached is None or cached < version:
+            cache.set(key, version, timeout=None)
+
+
+def forget_version(user_id):
+    """Drops the version of a deleted user, so its tokens fall back to
+    loading the user, which fails"""
+    key = _version_key(user_id)
+    cache.delete(key)
+    transaction.on_commit(lambda: cache.delete(key))
+
+
+class RefreshToken(jwt_tokens.RefreshToken):
+    """Only probes the blacklist for ids the revocation filter may contain"""
+
+    def check_blacklist(self):
+        if revocation.might_be_revoked(self.payload[api_settings.JTI_CLAIM]):
+            super().check_blacklist()
@@ -12,7 +12,7 @@ from .serializers import UserSerializer, select_serializer
 class UserViewSet(GenericViewSet):
     def get_serializer_class(self, request=None):
         if self.action == "partial_update" and request:
-            return select_serializer(request.user.role.id)
+            return select_serializer(request.user.role_id)
         return UserSerializer
 
     def get_permissions(self):
@@ -36,7 +36,7 @@ class UserViewSet(GenericViewSet):
             return Response(serializer.data, status=status.HTTP_200_OK)
 
     def partial_update(self, request, pk=None):
-        if request.user.role.id == Roles.USER and int(pk) != request.user.id:
+        if request.user.role_id == Roles.USER and int(pk) != request.user.id:
             raise PermissionDenied("Cannot change other users")
 
         user = get_object_or_404(User, id=pk)
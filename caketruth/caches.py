@@ -0,0 +1,15 @@
+"""Properties of the configured caches"""
+from django.conf import settings
+
+# backends whose entries are only seen by the process which wrote them
+PER_PROCESS_BACKENDS = {
+    "django.core.cache.backends.locmem.LocMemCache",
+    "django.core.cache.backends.dummy.DummyCache",
+}
+
+
+def is_shared(alias="default"):
+    """Tells whether all worker processes see the same cache entries,
+    which a per-process cache does when there is a single worker"""
+    return (settings.CACHES[alias]["BACKEND"] not in PER_PROCESS_BACKENDS
+            or settings.WORKERS == 1)
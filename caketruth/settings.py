@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/4.1/ref/settings/
 """
 
+import os
 from datetime import timedelta
 from pathlib import Path
 
@@ -38,6 +39,7 @@ INSTALLED_APPS = [
     "django.contrib.sessions",
     "django.contrib.messages",
     "django.contrib.staticfiles",
+    "django.contrib.postgres",
     "rest_framework",
     "rest_framework_simplejwt.token_blacklist",
     "authentication",
@@ -45,6 +47,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    "core.middleware.MetricsMiddleware",
+    "core.middleware.RequestTimingMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
@@ -86,9 +90,34 @@ DATABASES = {
         "PASSWORD": "",
         "HOST": "localhost",
         "PORT": "5432",
+        "OPTIONS": {
+            # Lets the food search tolerate a typo in short words
+            "options": "-c pg_trgm.word_similarity_threshold=0.4",
+        },
+    }
+}
+
+
+# Cache
+# https://docs.djangoproject.com/en/4.1/topics/cache/
+# Holds serialized catalog data (core/cache.py). Use a shared backend such
+# as Redis when running several worker processes: with a per-process cache
+# and more than one worker, the catalog cache is turned off.
+
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        "LOCATION": "caketruth",
+        "TIMEOUT": 600,
+        "OPTIONS": {
+            "MAX_ENTRIES": 10000,
+        },
     }
 }
 
+# Worker processes serving the app, gunicorn reads the same variable
+WORKERS = int(os.environ.get("WEB_CONCURRENCY", 1))
+
 
 # Password validation
 # https://docs.djangoproject.com/en/4.1/ref/settings/#auth-password-validators
@@ -136,12 +165,47 @@ REST_FRAMEWORK = {
     "DEFAULT_FILTER_BACKENDS": [
         "django_filters.rest_framework.DjangoFilterBackend"
     ],
+    # Trusts the claims of current access tokens only with a shared cache or
+    # a single worker, see authentication/tokens.py. Otherwise every request
+    # loads its user.
     "DEFAULT_AUTHENTICATION_CLASSES": [
-        "rest_framework_simplejwt.authentication.JWTAuthentication"
+        "authentication.backends.ClaimsJWTAuthentication"
     ],
 }
 
+# Request metrics served at /metrics, see core/metrics.py. With several
+# worker processes, point METRICS_DIR to a directory shared by them, the
+# system checks fail without it.
+METRICS_DIR = None
+METRICS_FLUSH_SECONDS = 5
+# Scrapers allowed to read /metrics: by address, or by a bearer token.
+# Behind a reverse proxy every client has the proxy's address, so only
+# list addresses of direct connections.
+METRICS_ALLOWED_IPS = []
+METRICS_TOKEN = None
+
+# Query counts and timings of every request, see core/middleware.py.
+# Requests slower than the threshold are logged with their SQL.
+REQUEST_TIMING = False
+REQUEST_TIMING_SLOW_MS = 500
+
+# Default page size of paginated lists and the upper bound for ?page_size=
+API_PAGE_SIZE = 50
+API_MAX_PAGE_SIZE = 500
+
+# Writes younger than this are held back by the catalog change feed until
+# concurrent transactions committed, see core/sync.py
+SYNC_SETTLE_SECONDS = 2
+
+# Food name autocompletion, see core/autocomplete.py
+AUTOCOMPLETE_SYNC_SECONDS = 1
+AUTOCOMPLETE_SYNC_BATCH = 1000
+AUTOCOMPLETE_REBUILD_SECONDS = 3600
+
 SIMPLE_JWT = {
     "REFRESH_TOKEN_LIFETIME": timedelta(days=15),
     "ROTATE_REFRESH_TOKENS": True,
+    "TOKEN_OBTAIN_SERIALIZER": "authentication.serializers.TokenObtainPairSerializer",
+    "TOKEN_REFRESH_SERIALIZER": "authentication.serializers.TokenRefreshSerializer",
+    "TOKEN_BLACKLIST_SERIALIZER": "authentication.serializers.TokenBlacklistSerializer",
 }
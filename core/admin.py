@@ -12,3 +12,4 @@ admin.site.register(RecipeCategory)
 admin.site.register(Recipe)
 admin.site.register(RecipeProduct)
 admin.site.register(Diary)
+admin.site.register(DiaryTotal)
@@ -0,0 +1,388 @@
+"""In-process prefix index of food names for autocompletion
+
+Every worker keeps the names sorted by their casefolded form, next to
+arrays of ids, food types and scores, so a prefix is a range found by two
+binary searches. Public and verified foods form the shared catalog, the
+other foods are kept in small indexes of their owners.
+
+Every process builds its own index: on first use, or in the background
+when start() is called from a hook which runs in the worker, such as
+gunicorn's post_fork. Requests arriving earlier wait for the build. A
+forked process drops the state copied from its parent, whose locks may
+have been held by a build. The index is kept current through the change feed of core/sync.py: at most
+every AUTOCOMPLETE_SYNC_SECONDS the foods written and deleted since the
+last sync are applied, read in batches of AUTOCOMPLETE_SYNC_BATCH rows.
+Scores rank verified foods first, then by the number of diary entries; as
+diary writes do not touch the foods, the index is rebuilt in the
+background every AUTOCOMPLETE_REBUILD_SECONDS to refresh them.
+
+Memory is O(1) per name: a list slot, the name itself (at most 64
+characters), 17 bytes of arrays and a bit of the catalog membership map.
+`stats()` reports the actual use, it is logged after every build.
+"""
+import heapq
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import Count, Q
+from django.utils import timezone
+
+from .models import Diary, Food, FoodTombstone
+
+logger = logging.getLogger(__name__)
+
+FIELDS = ["id", "name", "food_type_id", "is_public", "is_verified", "user_id"]
+# scores above this mark verified foods, the rest is the popularity
+VERIFIED = 1 << 48
+# best matches kept for prefixes of at least CACHED_RANGE names, enough
+# for the largest ?limit=
+CACHED_MATCHES = 50
+CACHED_RANGE = 1000
+CACHE_SIZE = 1024
+LAST_CHAR = chr(sys.maxunicode)
+
+
+class PrefixIndex:
+    """Names sorted by their casefolded form with parallel arrays
+
+    Short prefixes match large ranges, so their best matches are cached.
+    Writes keep the cached lists current and only drop the ones which
+    lose a member.
+    """
+
+    def __init__(self, entries=()):
+        entries = sorted(entries, key=lambda entry: entry[1].casefold())
+        self.names = [entry[1] for entry in entries]
+        self.ids = array("q", [entry[0] for entry in entries])
+        self.types = array("b", [entry[2] for entry in entries])
+        self.scores = array("q", [entry[3] for entry in entries])
+        self.cache = {}
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _position(self, pk, name):
+        key = name.casefold()
+        lo = bisect_left(self.names, key, key=str.casefold)
+        hi = bisect_right(self.names, key, lo=lo, key=str.casefold)
+        for i in range(lo, hi):
+            if self.ids[i] == pk:
+                return i
+        return None
+
+    def find(self, pk):
+        """Current name of a food, scans all ids, None if it is absent"""
+        try:
+            return self.names[self.ids.index(pk)]
+        except ValueError:
+            return None
+
+    def get(self, pk, name):
+        """(name, food type, score) of the food with that name, None if
+        it is absent"""
+        i = self._position(pk, name)
+        if i is None:
+            return None
+        return self.names[i], self.types[i], self.scores[i]
+
+    def add(self, pk, name, food_type, score):
+        key = name.casefold()
+        i = bisect_right(self.names, key, key=str.casefold)
+        self.names.insert(i, name)
+        self.ids.insert(i, pk)
+        self.types.insert(i, food_type)
+        self.scores.insert(i, score)
+        match = (score, pk, name, food_type)
+        for prefix, best in self.cache.items():
+            if key.startswith(prefix) and score > best[-1][0]:
+                # after the matches of the same score, like nlargest()
+                best.insert(bisect_right(best, -score, key=lambda m: -m[0]),
+                            match)
+                best.pop()
+
+    def remove(self, pk, name):
+        """Removes the food with that name if it is present"""
+        i = self._position(pk, name)
+        if i is None:
+            return
+        del self.names[i], self.ids[i], self.types[i], self.scores[i]
+        key = name.casefold()
+        for prefix in [prefix for prefix, best in self.cache.items()
+                       if key.startswith(prefix)
+                       and any(match[1] == pk for match in best)]:
+            del self.cache[prefix]
+
+    def search(self, prefix, limit):
+        """(score, id, name, food type) of the best matches, best first"""
+        cached = self.cache.get(prefix)
+        if cached is not None:
+            return cached[:limit]
+        lo = bisect_left(self.names, prefix, key=str.casefold)
+        hi = bisect_left(self.names, prefix + LAST_CHAR, lo=lo,
+                         key=str.casefold)
+        cache = hi - lo >= CACHED_RANGE
+        best = [(self.scores[i], self.ids[i], self.names[i], self.types[i])
+                for i in heapq.nlargest(
+                    CACHED_MATCHES if cache else limit, range(lo, hi),
+                    key=self.scores.__getitem__)]
+        if cache:
+            if len(self.cache) >= CACHE_SIZE:
+                del self.cache[next(iter(self.cache))]
+            self.cache[prefix] = best
+        return best[:limit]
+
+    def size(self):
+        """Bytes used by the names and the arrays"""
+        arrays = [self.ids, self.types, self.scores]
+        return (sys.getsizeof(self.names)
+                + sum(sys.getsizeof(name) for name in self.names)
+                + sum(sys.getsizeof(values) for values in arrays))
+
+
+class Autocomplete:
+    """The shared catalog and the owners' indexes of one worker"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.syncing = threading.Lock()
+        self.built_at = time.monotonic()
+        self.synced_at = self.built_at
+        # rows written before this are in the index
+        self.watermark = timezone.now()
+        popularity = dict(Diary.objects.values("food").annotate(
+            count=Count("id")).values_list("food", "count"))
+        catalog, own = [], {}
+        for pk, name, food_type, public, verified, user in \
+                Food.objects.values_list(*FIELDS).iterator(chunk_size=10000):
+            entry = (pk, name, food_type,
+                     _score(verified, popularity.get(pk, 0)))
+            if public or verified:
+                catalog.append(entry)
+            elif user is not None:
+                own.setdefault(user, []).append(entry)
+        # a bit per id tells which foods are in the catalog, so writes of
+        # new foods never scan it
+        self.shared = bytearray()
+        for entry in catalog:
+            self._set_shared(entry[0], True)
+        self.catalog = PrefixIndex(catalog)
+        self.own = {user: PrefixIndex(entries) for user, entries in own.items()}
+        # owners of the foods in self.own
+        self.owners = {entry[0]: user
+                       for user, entries in own.items() for entry in entries}
+
+    def _is_shared(self, pk):
+        return (pk >> 3 < len(self.shared)
+                and self.shared[pk >> 3] >> (pk & 7) & 1)
+
+    def _set_shared(self, pk, shared):
+        if pk >> 3 >= len(self.shared):
+            self.shared.extend(bytes((pk >> 3) - len(self.shared) + 1))
+        if shared:
+            self.shared[pk >> 3] |= 1 << (pk & 7)
+        else:
+            self.shared[pk >> 3] &= ~(1 << (pk & 7)) & 0xff
+
+    def _locate(self, pk, name):
+        """The index holding the food and its entry there, (None, None)
+        if the food is not indexed"""
+        user = self.owners.get(pk)
+        if user is not None:
+            index = self.own[user]
+        elif self._is_shared(pk):
+            index = self.catalog
+        else:
+            return None, None
+        entry = index.get(pk, name)
+        if entry is None:
+            # renamed, found the slow way
+            entry = index.get(pk, index.find(pk) or "")
+        return index, entry
+
+    def _remove(self, pk, index, name):
+        index.remove(pk, name)
+        if index is self.catalog:
+            self._set_shared(pk, False)
+            return
+        user = self.owners.pop(pk)
+        if not index:
+            del self.own[user]
+
+    def sync(self):
+        """Applies the foods written and deleted since the last sync
+
+        Rows are read again for SYNC_SETTLE_SECONDS, so foods of
+        transactions which committed late are not missed. Every batch is
+        applied under the lock on its own, so completions are not held up
+        by a large sync. Requests do not wait for a sync which another
+        thread is running.
+        """
+        if not self.syncing.acquire(blocking=False):  # pylint: disable=consider-using-with
+            return
+        try:
+            self._sync()
+        finally:
+            self.syncing.release()
+
+    def _sync(self):
+        now = timezone.now()
+        since = self.watermark - timedelta(seconds=settings.SYNC_SETTLE_SECONDS)
+        # tombstones go first, foods which left the catalog have one and
+        # are added again to the index of their owner
+        for batch in _batches(FoodTombstone.objects, "deleted_at", since,
+                              ["id", "name"]):
+            with self.lock:
+                for _, pk, name in batch:
+                    index, entry = self._locate(pk, name)
+                    if entry is not None:
+                        self._remove(pk, index, entry[0])
+        for batch in _batches(Food.objects, "updated_at", since, FIELDS):
+            with self.lock:
+                for _, *food in batch:
+                    self._apply(*food)
+        self.watermark = now
+        self.synced_at = time.monotonic()
+
+    def _apply(self, pk, name, food_type, public, verified, user):
+        shared = public or verified
+        index, entry = self._locate(pk, name)
+        score = _score(verified, entry[2] % VERIFIED if entry else 0)
+        if entry == (name, food_type, score) and (
+                self.owners.get(pk) == (None if shared else user)):
+            # read again within the settle time
+            return
+        if entry is not None:
+            self._remove(pk, index, entry[0])
+        if shared:
+            self.catalog.add(pk, name, food_type, score)
+            self._set_shared(pk, True)
+        elif user is not None:
+            self.own.setdefault(user, PrefixIndex()).add(
+                pk, name, food_type, score)
+            self.owners[pk] = user
+
+    def complete(self, prefix, user=None, limit=10):
+        """Best foods whose names start with the prefix, the catalog and
+        the foods of the user ranked together"""
+        prefix = prefix.casefold()
+        with self.lock:
+            matches = self.catalog.search(prefix, limit)
+            if user is not None and user in self.own:
+                matches = heapq.nlargest(
+                    limit, matches + self.own[user].search(prefix, limit),
+                    key=lambda match: match[0])
+        return [{"id": pk, "name": name, "food_type": food_type}
+                for _, pk, name, food_type in matches]
+
+    def stats(self):
+        names = len(self.catalog) + sum(len(index) for index in self.own.values())
+        size = self.catalog.size() + sys.getsizeof(self.shared) + sum(
+            index.size() for index in self.own.values())
+        return {
+            "names": names,
+            "bytes": size,
+            "bytes_per_million_names": size * 10**6 // max(names, 1),
+        }
+
+
+def _score(verified, popularity):
+    return (VERIFIED if verified else 0) + min(popularity, VERIFIED - 1)
+
+
+def _batches(manager, field, since, fields):
+    """Rows written since then in (time, id) order, as lists of at most
+    AUTOCOMPLETE_SYNC_BATCH (time, *fields) rows"""
+    queryset = manager.filter(**{f"{field}__gte": since}).order_by(field, "id")
+    size = settings.AUTOCOMPLETE_SYNC_BATCH
+    position = Q()
+    while True:
+        batch = list(
+            queryset.filter(position).values_list(field, *fields)[:size])
+        if batch:
+            yield batch
+        if len(batch) < size:
+            return
+        last, pk = batch[-1][:2]
+        position = Q(**{f"{field}__gt": last}) | Q(**{field: last, "id__gt": pk})
+
+
+_index = None
+_lock = threading.Lock()
+_rebuilding = threading.Event()
+_started = threading.Event()
+
+
+def _forget():
+    # pylint: disable-next=global-statement
+    global _index, _lock, _rebuilding, _started
+    _index = None
+    _lock = threading.Lock()
+    _rebuilding = threading.Event()
+    _started = threading.Event()
+
+
+os.register_at_fork(after_in_child=_forget)
+
+
+def _build():
+    global _index  # pylint: disable=global-statement
+    index = Autocomplete()
+    logger.info(json.dumps({"autocomplete": index.stats()}))
+    _index = index
+
+
+def _rebuild():
+    try:
+        _build()
+    finally:
+        _rebuilding.clear()
+        connection.close()
+
+
+def _build_at_start():
+    try:
+        with _lock:
+            if _index is None:
+                _build()
+    finally:
+        connection.close()
+
+
+def start():
+    """Builds the index of this process in the background, once"""
+    if not _started.is_set():
+        _started.set()
+        threading.Thread(target=_build_at_start, daemon=True).start()
+
+
+def get_index():
+    """The index of this process, built if no build was started, and
+    synced"""
+    if _index is None:
+        with _lock:
+            if _index is None:
+                _build()
+    index = _index
+    now = time.monotonic()
+    if (now - index.built_at >= settings.AUTOCOMPLETE_REBUILD_SECONDS
+            and not _rebuilding.is_set()):
+        _rebuilding.set()
+        threading.Thread(target=_rebuild, daemon=True).start()
+    if now - index.synced_at >= settings.AUTOCOMPLETE_SYNC_SECONDS:
+        index.sync()
+    return index
+
+
+def reset():
+    """Drops the index of this worker, e.g. between tests"""
+    global _index  # pylint: disable=global-statement
+    _index = None
@@ -0,0 +1,23 @@
+"""Validation of EAN/UPC barcodes (GTINs)"""
+
+LENGTHS = (8, 12, 13, 14)
+
+
+def normalize(code):
+    """Checked GTIN of an EAN-8, UPC-A, EAN-13 or GTIN-14 code
+
+    UPC-A codes are returned as the EAN-13 with a leading zero, which is
+    the same number, so either form finds the product. Raises ValueError
+    if the code is malformed or its check digit is wrong.
+    """
+    code = code.strip()
+    if not (code.isascii() and code.isdigit()) or len(code) not in LENGTHS:
+        raise ValueError("not an EAN or UPC code")
+    if len(code) == 12:
+        code = "0" + code
+    # digits are weighted 3, 1, 3... from the right, the check digit aside
+    total = sum(int(digit) * (1 if i % 2 else 3)
+                for i, digit in enumerate(reversed(code[:-1])))
+    if (10 - total % 10) % 10 != int(code[-1]):
+        raise ValueError("wrong check digit")
+    return code
@@ -0,0 +1,90 @@
+"""Read-through cache of serialized catalog data
+
+Detail representations are stored under the id of the object and deleted
+when it is written. List pages depend on many objects, so their keys carry
+a per-resource version which every write to the resource replaces.
+Objects have versions of their own, which serve as validators for
+conditional requests to the detail endpoints.
+
+Invalidations only reach the processes which see the same cache, so with
+a per-process cache the catalog cache is only used by a single worker.
+"""
+import time
+from hashlib import md5
+
+from django.core.cache import cache
+from django.db import transaction
+
+from caketruth import caches
+
+CATALOG = ["products", "recipes", "product-brands", "product-categories",
+           "recipe-categories"]
+
+
+def enabled():
+    """Tells whether catalog reads may be served from the cache"""
+    return caches.is_shared()
+
+
+def _version_key(resource, pk=None):
+    if pk is None:
+        return f"catalog:{resource}:version"
+    return f"catalog:{resource}:version:{pk}"
+
+
+def _detail_key(resource, pk):
+    return f"catalog:{resource}:detail:{pk}"
+
+
+def get_version(resource, pk=None):
+    """Current version of a resource or one of its objects
+
+    Versions are nanosecond timestamps of the last write, or of the first
+    read if the write happened before the cache was filled.
+    """
+    key = _version_key(resource, pk)
+    version = cache.get(key)
+    if version is None:
+        version = time.time_ns()
+        if not cache.add(key, version, timeout=None):
+            version = cache.get(key, version)
+    return version
+
+
+def list_key(resource, request, version):
+    query = f"{request.get_host()}{request.get_full_path()}"
+    digest = md5(query.encode(), usedforsecurity=False).hexdigest()
+    return f"catalog:{resource}:list:{version}:{digest}"
+
+
+def get_detail(resource, pk, version):
+    """Cached representation of an object if it is still of that version"""
+    entry = cache.get(_detail_key(resource, pk))
+    if entry is not None and entry[0] == version:
+        return entry[1]
+    return None
+
+
+def set_detail(resource, pk, version, data):
+    # the version is read before the object, so data loaded concurrently
+    # with a write is stored under the old version and never served
+    cache.set(_detail_key(resource, pk), (version, data))
+
+
+def invalidate(resource, *pks):
+    """Drops cached details of the given objects and all list pages
+
+    Inside a transaction this is repeated after the commit, so a read
+    which raced with the write cannot leave the old data in the cache.
+    """
+    _invalidate(resource, pks)
+    if transaction.get_connection().in_atomic_block:
+        transaction.on_commit(lambda: _invalidate(resource, pks))
+
+
+def _invalidate(resource, pks):
+    cache.delete_many([_detail_key(resource, pk) for pk in pks])
+    version = max(time.time_ns(), get_version(resource) + 1)
+    versions = {_version_key(resource, pk): version for pk in pks}
+    versions[_version_key(resource)] = version
+    cache.set_many(versions, timeout=None)
@@ -0,0 +1,16 @@
+"""System checks of the core app"""
+from django.core.checks import Error, register
+
+from . import metrics
+
+
+@register()
+def check_metrics_dir(app_configs, **kwargs):
+    if metrics.is_aggregated():
+        return []
+    return [Error(
+        "Several WORKERS without METRICS_DIR, /metrics would only report "
+        "the counters of the worker answering the scrape.",
+        hint="Set METRICS_DIR to a directory shared by the workers.",
+        id="core.E001",
+    )]
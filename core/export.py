@@ -0,0 +1,79 @@
+"""Streaming export of diary entries
+
+Rows are read through a server-side cursor and written in chunks, so the
+memory used does not depend on the length of the history and the header
+goes out before the first row is read.
+"""
+import csv
+import json
+from itertools import chain, islice
+
+from rest_framework import renderers
+from rest_framework.fields import DateTimeField
+
+from .models import FoodType
+
+COLUMNS = ["id", "added_date", "meal", "food", "food_name", "food_type",
+           "mass", "calc_calories", "calc_proteins", "calc_fats",
+           "calc_carbs", "calc_ethanol"]
+VALUES = ["id", "added_date", "meal__name", "food_id", "food__name",
+          "food__food_type_id", "mass", "calc_calories", "calc_proteins",
+          "calc_fats", "calc_carbs", "calc_ethanol"]
+CHUNK_SIZE = 2000
+
+
+class CSVRenderer(renderers.BaseRenderer):
+    """Selects CSV export, the rows themselves are streamed by the view
+
+    Only error responses pass through the renderer.
+    """
+    media_type = "text/csv"
+    format = "csv"
+    charset = "utf-8"
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        return json.dumps(data)
+
+
+class NDJSONRenderer(CSVRenderer):
+    """Selects newline-delimited JSON export"""
+    media_type = "application/x-ndjson"
+    format = "ndjson"
+
+
+def export_rows(entries):
+    """Yields diary entries as lists of values in COLUMNS order"""
+    food_types = dict(FoodType.objects.values_list("id", "name"))
+    dates = DateTimeField()
+    rows = entries.order_by("added_date", "id").values_list(*VALUES)
+    for row in rows.iterator(chunk_size=CHUNK_SIZE):
+        row = list(row)
+        row[1] = dates.to_representation(row[1])
+        row[5] = food_types.get(row[5])
+        yield row
+
+
+class _Echo:
+    """File-like target of csv.writer, writerow() returns the line"""
+
+    def write(self, value):
+        return value
+
+
+def _stream(lines):
+    """Joins lines into chunks, the first one is sent on its own"""
+    lines = iter(lines)
+    yield from islice(lines, 1)
+    while chunk := "".join(islice(lines, CHUNK_SIZE)):
+        yield chunk
+
+
+def stream_csv(rows):
+    writer = csv.writer(_Echo())
+    yield from _stream(chain(
+        [writer.writerow(COLUMNS)], (writer.writerow(row) for row in rows)))
+
+
+def stream_ndjson(rows):
+    yield from _stream(
+        json.dumps(dict(zip(COLUMNS, row))) + "\n" for row in rows)
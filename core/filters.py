@@ -0,0 +1,58 @@
+"""Filter backends for core viewsets"""
+from django.contrib.postgres.search import (SearchQuery, SearchRank,
+                                            SearchVector, TrigramWordSimilarity)
+from django.db.models import FloatField, Q, Value
+from django.db.models.functions import Cast, Greatest
+from rest_framework.filters import BaseFilterBackend
+
+from .models import Food
+
+
+class FoodSearchFilter(BaseFilterBackend):
+    """Ranked search over food names and related titles (?q=...)
+
+    Names are matched both by full-text search and by trigram word
+    similarity, so typos still find results. Both conditions are served by
+    the GIN indexes on core_food. Views may list foreign keys in
+    `search_title_fields` whose `title` is matched as well (brand, category).
+    Matches on related titles rank lower than matches on the name.
+
+    Ranked results are paged by rank when the view uses cursor pagination.
+    """
+    search_param = "q"
+    search_ordering = ("-rank", "id")
+    title_weight = 0.5
+
+    def filter_queryset(self, request, queryset, view):
+        query = request.query_params.get(self.search_param, "").strip()
+        if not query:
+            return queryset
+
+        search_vector = SearchVector("name", config="simple")
+        search_query = SearchQuery(query, config="simple")
+        model = queryset.model
+        # each branch is answered by its own index, the union stays small
+        matches = Food.objects.alias(search_vector=search_vector).filter(
+            Q(search_vector=search_query) | Q(name__trigram_word_similar=query)
+        ).values("id")
+        ranks = [
+            SearchRank(search_vector, search_query),
+            TrigramWordSimilarity(query, "name"),
+        ]
+        for field in getattr(view, "search_title_fields", []):
+            related = model._meta.get_field(field).related_model
+            titles = related.objects.filter(title__trigram_word_similar=query)
+            matches = matches.union(model.objects.filter(
+                **{f"{field}__in": titles.values("id")}).values("id"))
+            ranks.append(TrigramWordSimilarity(query, f"{field}__title")
+                         * Value(self.title_weight))
+
+        # double precision keeps the rank exact in pagination cursors
+        return queryset.filter(pk__in=matches).annotate(
+            rank=Cast(Greatest(*ranks), FloatField())
+        ).order_by(*self.search_ordering)
+
+    def get_ordering(self, request, queryset, view):
+        if request.query_params.get(self.search_param, "").strip():
+            return self.search_ordering
+        return view.pagination_class.ordering
@@ -0,0 +1,286 @@
+"""Measures the latency and query counts of the API endpoints"""
+import json
+import platform
+import random
+import statistics
+import sys
+import time
+
+import django
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext, override_settings
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.settings import api_settings
+
+from authentication import tokens
+from authentication.models import User
+from core.models import (FoodTypes, Meal, Product, ProductBarcode,
+                         ProductBrand, ProductCategory, Recipe, RecipeCategory)
+from core.synthetic import PASSWORD, generate
+
+HOST = "localhost"
+
+
+class Command(BaseCommand):
+    help = (
+        "Seeds a synthetic dataset, requests every API endpoint repeatedly "
+        "and writes latency percentiles and query counts as JSON. "
+        "Everything runs in a transaction which is rolled back, but the "
+        "cache is cleared, so use a development database."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=10)
+        parser.add_argument("--products", type=int, default=1000)
+        parser.add_argument("--brands", type=int, default=50)
+        parser.add_argument("--categories", type=int, default=20)
+        parser.add_argument("--recipes", type=int, default=200)
+        parser.add_argument("--ingredients", type=int, default=5,
+                            help="Products per recipe")
+        parser.add_argument("--diary", type=int, default=500,
+                            help="Diary entries per user")
+        parser.add_argument("--repeat", type=int, default=20,
+                            help="Measured requests per endpoint")
+        parser.add_argument("--seed", type=int, default=1)
+        parser.add_argument("--cold", action="store_true",
+                            help="Clear the cache before every request")
+        parser.add_argument("--output", help="Report file, default stdout")
+
+    def handle(self, *args, **options):
+        dataset = {key: options[key] for key in [
+            "users", "products", "brands", "categories", "recipes",
+            "ingredients", "diary"]}
+        cache.clear()
+        with transaction.atomic(), override_settings(ALLOWED_HOSTS=[HOST]):
+            started = time.perf_counter()
+            data = generate(random.Random(options["seed"]), **dataset)
+            seeded = time.perf_counter() - started
+            self.stderr.write(f"Dataset seeded in {seeded:.1f} s")
+            results = {
+                name: self._measure(method, path, body, options)
+                for name, method, path, body in self._endpoints(data)
+            }
+            transaction.set_rollback(True)
+        cache.clear()
+
+        report = {
+            "environment": {
+                "python": platform.python_version(),
+                "django": django.get_version(),
+                "database": connection.vendor,
+            },
+            "options": {**dataset, "seed": options["seed"],
+                        "repeat": options["repeat"], "cold": options["cold"]},
+            "endpoints": results,
+        }
+        text = json.dumps(report, indent=2, sort_keys=True) + "\n"
+        if options["output"]:
+            with open(options["output"], "w", encoding="utf-8") as file:
+                file.write(text)
+        else:
+            sys.stdout.write(text)
+
+    def _endpoints(self, data):
+        """(name, method, path, body) of every request to measure"""
+        user = User.objects.get(pk=data.users[0])
+        refresh = tokens.add_claims(
+            tokens.RefreshToken.for_user(user), user)
+        self.client = APIClient(SERVER_NAME=HOST)
+        self.client.credentials(**{api_settings.AUTH_HEADER_NAME: (
+            f"{api_settings.AUTH_HEADER_TYPES[0]} {refresh.access_token}")})
+
+        meal = data.meals[user.id][0]
+        product, recipe = data.products[0], data.recipes[0]
+        diary = data.diary[0]
+        entry = {"mass": 100, "meal": meal, "food": product}
+        names = iter(range(sys.maxsize))
+        codes = [_barcode(i) for i in range(min(len(data.products), 100))]
+        ProductBarcode.objects.bulk_create(
+            ProductBarcode(product_id=pk, code=code)
+            for pk, code in zip(data.products, codes))
+        nutrients = {"calories": 100, "proteins": 10, "fats": 10, "carbs": 10}
+
+        def fresh(template, create):
+            """A path to an object created for every request, for deletes"""
+            return template, lambda: template.format(create())
+
+        def new_food(model, **fields):
+            return lambda: model.objects.create(
+                name=f"Deleted {next(names)}", user=user, **nutrients,
+                **fields).pk
+
+        def new_entry():
+            # through the API, which keeps the diary rollups
+            return self.client.post(
+                "/api/diary/", entry, format="json").json()["id"]
+
+        def recipe_body():
+            return {"name": f"Recipe {next(names)}", "directions": "Mix",
+                    "mass": 300, "products": [
+                        {"product": pk, "mass": 100}
+                        for pk in data.products[:3]]}
+
+        return [
+            ("meals-list", "get", "/api/meals/", None),
+            ("meals-detail", "get", f"/api/meals/{meal}/", None),
+            ("meals-create", "post", "/api/meals/",
+             lambda: {"name": f"Meal {next(names)}"}),
+            ("meals-update", "put", f"/api/meals/{meal}/",
+             lambda: {"name": f"Meal {next(names)}"}),
+            ("meals-partial-update", "patch", f"/api/meals/{meal}/",
+             lambda: {"name": f"Meal {next(names)}"}),
+            ("meals-destroy", "delete", fresh("/api/meals/{}/", lambda:
+                Meal.objects.create(name="Deleted", user=user).pk), None),
+            ("product-categories-list", "get", "/api/product-categories/", None),
+            ("product-categories-detail", "get",
+             f"/api/product-categories/{data.categories[0]}/", None),
+            ("product-categories-create", "post", "/api/product-categories/",
+             lambda: {"title": f"Category {next(names)}"}),
+            ("product-categories-update", "put",
+             f"/api/product-categories/{data.categories[0]}/",
+             lambda: {"title": f"Category {next(names)}"}),
+            ("product-categories-partial-update", "patch",
+             f"/api/product-categories/{data.categories[0]}/",
+             lambda: {"title": f"Category {next(names)}"}),
+            ("product-categories-destroy", "delete", fresh(
+                "/api/product-categories/{}/", lambda:
+                ProductCategory.objects.create(title="Deleted").pk), None),
+            ("product-brands-list", "get", "/api/product-brands/", None),
+            ("product-brands-detail", "get",
+             f"/api/product-brands/{data.brands[0]}/", None),
+            ("product-brands-create", "post", "/api/product-brands/",
+             lambda: {"title": f"Brand {next(names)}"}),
+            ("product-brands-update", "put",
+             f"/api/product-brands/{data.brands[0]}/",
+             lambda: {"title": f"Brand {next(names)}"}),
+            ("product-brands-partial-update", "patch",
+             f"/api/product-brands/{data.brands[0]}/",
+             lambda: {"title": f"Brand {next(names)}"}),
+            ("product-brands-destroy", "delete", fresh(
+                "/api/product-brands/{}/", lambda:
+                ProductBrand.objects.create(title="Deleted").pk), None),
+            ("products-list", "get", "/api/products/", None),
+            ("products-list-large", "get", "/api/products/?page_size=500",
+             None),
+            ("products-search", "get", "/api/products/?q=chiken", None),
+            ("products-detail", "get", f"/api/products/{product}/", None),
+            ("products-update", "put", f"/api/products/{product}/",
+             lambda: {"name": f"Renamed product {next(names)}", **nutrients}),
+            ("products-partial-update", "patch", f"/api/products/{product}/",
+             lambda: {"name": f"Renamed product {next(names)}"}),
+            ("products-create", "post", "/api/products/",
+             lambda: {"name": f"Product {next(names)}", **nutrients}),
+            ("products-destroy", "delete", fresh(
+                "/api/products/{}/",
+                new_food(Product, food_type_id=FoodTypes.PRODUCT)), None),
+            ("products-barcode", "get", f"/api/products/barcodes/{codes[0]}/",
+             None),
+            ("products-barcodes-batch", "post", "/api/products/barcodes/",
+             lambda: {"codes": codes}),
+            ("autocomplete", "get", "/api/autocomplete/?q=ch", None),
+            ("changes", "get", "/api/changes/", None),
+            ("changes-large", "get", "/api/changes/?page_size=500", None),
+            ("recipe-categories-list", "get", "/api/recipe-categories/", None),
+            ("recipe-categories-detail", "get",
+             f"/api/recipe-categories/{data.recipe_categories[0]}/", None),
+            ("recipe-categories-create", "post", "/api/recipe-categories/",
+             lambda: {"title": f"Category {next(names)}"}),
+            ("recipe-categories-update", "put",
+             f"/api/recipe-categories/{data.recipe_categories[0]}/",
+             lambda: {"title": f"Category {next(names)}"}),
+            ("recipe-categories-partial-update", "patch",
+             f"/api/recipe-categories/{data.recipe_categories[0]}/",
+             lambda: {"title": f"Category {next(names)}"}),
+            ("recipe-categories-destroy", "delete", fresh(
+                "/api/recipe-categories/{}/", lambda:
+                RecipeCategory.objects.create(title="Deleted").pk), None),
+            ("recipes-list", "get", "/api/recipes/", None),
+            ("recipes-list-large", "get", "/api/recipes/?page_size=500", None),
+            ("recipes-list-expanded", "get", "/api/recipes/?expand=products",
+             None),
+            ("recipes-detail", "get", f"/api/recipes/{recipe}/", None),
+            ("recipes-update", "put", f"/api/recipes/{recipe}/", recipe_body),
+            ("recipes-partial-update", "patch", f"/api/recipes/{recipe}/",
+             lambda: {"name": f"Renamed recipe {next(names)}"}),
+            ("recipes-create", "post", "/api/recipes/", recipe_body),
+            ("recipes-destroy", "delete", fresh(
+                "/api/recipes/{}/", new_food(
+                    Recipe, food_type_id=FoodTypes.RECIPE, directions="Mix",
+                    mass=100)), None),
+            ("diary-list", "get", "/api/diary/", None),
+            ("diary-detail", "get", f"/api/diary/{diary}/", None),
+            ("diary-create", "post", "/api/diary/", lambda: entry),
+            ("diary-update", "put", f"/api/diary/{diary}/",
+             lambda: {**entry, "mass": 100 + next(names) % 100}),
+            ("diary-partial-update", "patch", f"/api/diary/{diary}/",
+             lambda: {"mass": 100 + next(names) % 100}),
+            ("diary-destroy", "delete", fresh("/api/diary/{}/", new_entry),
+             None),
+            ("diary-bulk", "post", "/api/diary/bulk/", lambda: [entry] * 10),
+            ("diary-summary", "get", "/api/diary/summary/?period=week", None),
+            ("diary-export", "get", "/api/diary/export/", None),
+            ("users-create", "post", "/api/users/", lambda: {
+                "email": f"new{next(names)}@example.com",
+                "username": f"new{next(names)}", "password": PASSWORD,
+                "password_confirm": PASSWORD}),
+            ("users-detail", "get", f"/api/users/{user.id}/", None),
+            ("users-partial-update", "patch", f"/api/users/{user.id}/",
+             lambda: {"username": f"renamed{next(names)}"}),
+            ("users-login", "post", "/api/users/login/",
+             lambda: {"email": user.email, "password": PASSWORD}),
+            ("users-login-refresh", "post", "/api/users/login/refresh/",
+             lambda: {"refresh": str(refresh)}),
+            ("users-logout", "post", "/api/users/logout/",
+             lambda: {"refresh": str(tokens.RefreshToken.for_user(user))}),
+        ]
+
+    def _request(self, method, path, data):
+        kwargs = {"format": "json"} if data is not None else {}
+        response = getattr(self.client, method)(path, data, **kwargs)
+        if response.streaming:
+            for _ in response.streaming_content:
+                pass
+        return response
+
+    def _measure(self, method, path, body, options):
+        """Requests the endpoint, paths and bodies are made untimed"""
+        template, make_path = path if isinstance(path, tuple) else (
+            path, lambda: path)
+        if not options["cold"]:
+            self._request(method, make_path(), body() if body else None)
+        durations, queries, statuses = [], [], set()
+        for _ in range(options["repeat"]):
+            if options["cold"]:
+                cache.clear()
+            url, data = make_path(), body() if body else None
+            with CaptureQueriesContext(connection) as captured:
+                started = time.perf_counter()
+                response = self._request(method, url, data)
+                durations.append((time.perf_counter() - started) * 1000)
+            queries.append(len(captured))
+            statuses.add(response.status_code)
+
+        percentiles = statistics.quantiles(
+            durations, n=100, method="inclusive") if len(durations) > 1 \
+            else durations * 99
+        return {
+            "method": method.upper(),
+            "path": template,
+            "status": sorted(statuses),
+            "p50_ms": round(percentiles[49], 2),
+            "p90_ms": round(percentiles[89], 2),
+            "p99_ms": round(percentiles[98], 2),
+            "mean_ms": round(statistics.fmean(durations), 2),
+            "queries": statistics.median_low(queries),
+            "max_queries": max(queries),
+        }
+
+
+def _barcode(number):
+    """EAN-13 code with a valid check digit"""
+    code = f"200{number:09d}"
+    total = sum(int(digit) * (1 if i % 2 else 3)
+                for i, digit in enumerate(reversed(code)))
+    return code + str((10 - total % 10) % 10)
@@ -0,0 +1,130 @@
+"""Imports products from a CSV or JSON Lines supplier dump"""
+import csv
+import json
+from itertools import islice
+from pathlib import Path
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from core import cache as catalog_cache
+from core.models import (Food, FoodTypes, Product, ProductBrand,
+                         ProductCategory, bulk_create_foods)
+
+NUTRIENTS = ["calories", "proteins", "fats", "carbs", "ethanol"]
+OPTIONAL_NUMBERS = ["net_grams", "drained_grams"]
+
+
+class Command(BaseCommand):
+    help = (
+        "Imports products from a CSV file with a header row or a JSON Lines "
+        "file. Recognized columns: name, calories, proteins, fats, carbs, "
+        "ethanol, net_grams, drained_grams, brand, category. Brands and "
+        "categories are matched by title and created when missing."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", type=Path)
+        parser.add_argument("--format", choices=["csv", "jsonl"],
+                            help="Defaults to the file extension")
+        parser.add_argument("--chunk-size", type=int, default=1000)
+        parser.add_argument("--public", action="store_true",
+                            help="Make the imported products public")
+        parser.add_argument("--verified", action="store_true",
+                            help="Mark the imported products as verified")
+
+    def handle(self, *args, **options):
+        path = options["path"]
+        file_format = options["format"] or path.suffix.lstrip(".").lower()
+        if file_format not in ("csv", "jsonl"):
+            raise CommandError(f"Unknown input format: {file_format}")
+        self.flags = {"is_public": options["public"],
+                      "is_verified": options["verified"]}
+        self.brands = dict(
+            ProductBrand.objects.values_list("title", "id"))
+        self.categories = dict(
+            ProductCategory.objects.values_list("title", "id"))
+
+        imported = skipped = 0
+        with path.open(encoding="utf-8", newline="") as file:
+            rows = self._read(file, file_format)
+            while chunk := list(islice(rows, options["chunk_size"])):
+                products = []
+                for line, row in chunk:
+                    try:
+                        products.append(self._parse(row))
+                    except (KeyError, TypeError, ValueError) as error:
+                        skipped += 1
+                        self.stderr.write(f"{path}:{line}: skipped ({error})")
+                self._insert(products)
+                imported += len(products)
+                self.stdout.write(f"{imported} products imported")
+
+        for resource in ("products", "product-brands", "product-categories"):
+            catalog_cache.invalidate(resource)
+        self.stdout.write(self.style.SUCCESS(
+            f"Done: {imported} imported, {skipped} skipped"))
+
+    def _read(self, file, file_format):
+        if file_format == "csv":
+            # line 1 is the header
+            yield from enumerate(csv.DictReader(file), start=2)
+            return
+        for line, text in enumerate(file, start=1):
+            if text.strip():
+                try:
+                    yield line, json.loads(text)
+                except json.JSONDecodeError as error:
+                    yield line, error
+
+    def _parse(self, row):
+        if isinstance(row, Exception):
+            raise ValueError(row)
+        name = (row["name"] or "").strip()
+        if not name or len(name) > Food._meta.get_field("name").max_length:
+            raise ValueError("invalid name")
+        data = {"name": name}
+        for key in NUTRIENTS:
+            value = row.get(key)
+            value = round(float(value), 2) if value not in (None, "") else 0.0
+            if not 0 <= value <= (900 if key == "calories" else 100):
+                raise ValueError(f"{key} out of range")
+            data[key] = value
+        for key in OPTIONAL_NUMBERS:
+            value = row.get(key)
+            data[key] = float(value) if value not in (None, "") else None
+        for key in ("brand", "category"):
+            data[key] = (row.get(key) or "").strip() or None
+            if data[key] and len(data[key]) > 64:
+                raise ValueError(f"{key} is too long")
+        return data
+
+    def _resolve_titles(self, model, lookup, titles):
+        """Creates missing brands or categories, keeps title -> id in memory"""
+        missing = {title for title in titles if title and title not in lookup}
+        if missing:
+            created = model.objects.bulk_create(
+                [model(title=title) for title in missing])
+            lookup.update((item.title, item.id) for item in created)
+
+    def _insert(self, products):
+        if not products:
+            return
+        with transaction.atomic():
+            self._resolve_titles(ProductBrand, self.brands,
+                                 [p["brand"] for p in products])
+            self._resolve_titles(ProductCategory, self.categories,
+                                 [p["category"] for p in products])
+            bulk_create_foods(Product, [
+                Food(food_type_id=FoodTypes.PRODUCT, **self.flags,
+                     **{key: p[key] for key in ["name", *NUTRIENTS]})
+                for p in products
+            ], [
+                Product(
+                    net_grams=p["net_grams"],
+                    drained_grams=p["drained_grams"],
+                    product_brand_id=self.brands.get(p["brand"]),
+                    product_category_id=self.categories.get(p["category"]),
+                )
+                for p in products
+            ])
@@ -0,0 +1,20 @@
+"""Recomputes the DiaryTotal rollup table from the diary"""
+from django.core.management.base import BaseCommand
+
+from core.rollups import rebuild_totals
+
+
+class Command(BaseCommand):
+    help = (
+        "Recomputes daily diary totals from the diary entries. Totals are "
+        "maintained on every write through the API, use this after changing "
+        "entries by other means (admin, raw SQL)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--user", type=int, action="append", dest="users",
+                            help="Only rebuild the totals of this user id")
+
+    def handle(self, *args, **options):
+        rebuild_totals(options["users"])
+        self.stdout.write(self.style.SUCCESS("Diary totals rebuilt"))
@@ -0,0 +1,204 @@
+"""Request metrics in the Prometheus text format
+
+Requests are counted by route (the router basename) and action, with a
+latency histogram and the number of database queries. Every thread
+updates counters of its own, so recording needs no locks; the exporter
+adds the threads up.
+
+Worker processes do not share memory. With METRICS_DIR set, each process
+writes its counters to a file in that directory every
+METRICS_FLUSH_SECONDS, and /metrics adds up the files of the other
+processes. The directory should be emptied before the workers start.
+Without it, several WORKERS would each report their own counters, so
+the system checks and /metrics fail instead.
+
+/metrics answers the addresses in METRICS_ALLOWED_IPS and requests with
+the bearer token METRICS_TOKEN, everyone else gets a 404. Behind a
+reverse proxy every client has the proxy's address, so the token is the
+safe choice there.
+"""
+import hmac
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+from pathlib import Path
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.http import Http404, HttpResponse
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+_local = threading.local()
+_stores = []
+_stores_lock = threading.Lock()
+_flush_lock = threading.Lock()
+_next_flush = 0.0
+
+
+def _empty():
+    return {"requests": {}, "queries": {}, "durations": {}}
+
+
+def _store():
+    store = getattr(_local, "store", None)
+    if store is None:
+        store = _local.store = _empty()
+        with _stores_lock:
+            _stores.append(store)
+    return store
+
+
+def route_of(view, method):
+    """Router basename and action of a resolved view"""
+    cls = getattr(view, "cls", None)
+    route = getattr(view, "initkwargs", {}).get("basename")
+    if route is None:
+        route = cls.__name__ if cls else view.__name__
+    actions = getattr(view, "actions", None) or {}
+    return route, actions.get(method.lower(), method.lower())
+
+
+def observe(route, action, status, duration, queries):
+    """Records a handled request, called by MetricsMiddleware"""
+    store = _store()
+    labels = (route, action)
+    requests = store["requests"]
+    key = (route, action, str(status))
+    requests[key] = requests.get(key, 0) + 1
+    store["queries"][labels] = store["queries"].get(labels, 0) + queries
+    histogram = store["durations"].get(labels)
+    if histogram is None:
+        # one count per bucket, then +Inf and the sum
+        histogram = store["durations"][labels] = [0] * (len(BUCKETS) + 1) + [0.0]
+    histogram[bisect_left(BUCKETS, duration)] += 1
+    histogram[-1] += duration
+    if settings.METRICS_DIR and time.monotonic() >= _next_flush:
+        _flush()
+
+
+def _merge(total, metric, labels, value):
+    current = total[metric].get(labels)
+    if current is None:
+        total[metric][labels] = list(value) if isinstance(value, list) else value
+    elif isinstance(value, list):
+        total[metric][labels] = [a + b for a, b in zip(current, value)]
+    else:
+        total[metric][labels] = current + value
+
+
+def _local_totals():
+    """Counters of the threads of this process"""
+    total = _empty()
+    with _stores_lock:
+        stores = list(_stores)
+    for store in stores:
+        for metric, values in store.items():
+            # copying is atomic under the GIL, the owner may keep writing
+            for labels, value in list(values.items()):
+                _merge(total, metric, labels, value)
+    return total
+
+
+def _path(pid):
+    return Path(settings.METRICS_DIR) / f"metrics-{pid}.json"
+
+
+def _flush():
+    global _next_flush  # pylint: disable=global-statement
+    if not _flush_lock.acquire(blocking=False):
+        return
+    try:
+        _next_flush = time.monotonic() + settings.METRICS_FLUSH_SECONDS
+        path = _path(os.getpid())
+        temporary = path.with_suffix(".tmp")
+        # JSON has no tuple keys, labels are stored as lists
+        temporary.write_text(json.dumps({
+            metric: [[list(labels), value] for labels, value in values.items()]
+            for metric, values in _local_totals().items()}))
+        os.replace(temporary, path)
+    finally:
+        _flush_lock.release()
+
+
+def collect():
+    """Counters of all processes"""
+    total = _local_totals()
+    if settings.METRICS_DIR:
+        own = _path(os.getpid())
+        for path in Path(settings.METRICS_DIR).glob("metrics-*.json"):
+            if path == own:
+                continue
+            for metric, values in json.loads(path.read_text()).items():
+                for labels, value in values:
+                    _merge(total, metric, tuple(labels), value)
+    return total
+
+
+def _labels(names, values, **extra):
+    pairs = list(zip(names, values)) + list(extra.items())
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"')
+               .replace("\n", "\\n") for _, value in pairs)
+    return ",".join(f'{name}="{value}"'
+                    for (name, _), value in zip(pairs, escaped))
+
+
+def render():
+    total = collect()
+    lines = [
+        "# HELP caketruth_requests_total Handled requests",
+        "# TYPE caketruth_requests_total counter",
+    ]
+    for labels, value in sorted(total["requests"].items()):
+        lines.append("caketruth_requests_total{%s} %s" % (
+            _labels(("route", "action", "status"), labels), value))
+
+    lines += [
+        "# HELP caketruth_request_duration_seconds Request latency",
+        "# TYPE caketruth_request_duration_seconds histogram",
+    ]
+    for labels, histogram in sorted(total["durations"].items()):
+        cumulative = 0
+        for bound, count in zip(BUCKETS + ("+Inf",), histogram):
+            cumulative += count
+            lines.append("caketruth_request_duration_seconds_bucket{%s} %s" % (
+                _labels(("route", "action"), labels, le=bound), cumulative))
+        names = _labels(("route", "action"), labels)
+        lines.append(f"caketruth_request_duration_seconds_sum{{{names}}} "
+                     f"{histogram[-1]}")
+        lines.append(f"caketruth_request_duration_seconds_count{{{names}}} "
+                     f"{cumulative}")
+
+    lines += [
+        "# HELP caketruth_db_queries_total Database queries made by requests",
+        "# TYPE caketruth_db_queries_total counter",
+    ]
+    for labels, value in sorted(total["queries"].items()):
+        lines.append("caketruth_db_queries_total{%s} %s" % (
+            _labels(("route", "action"), labels), value))
+    return "\n".join(lines) + "\n"
+
+
+def is_aggregated():
+    """Tells whether /metrics covers every worker process"""
+    return bool(settings.METRICS_DIR) or settings.WORKERS == 1
+
+
+def _is_allowed(request):
+    if request.META.get("REMOTE_ADDR") in settings.METRICS_ALLOWED_IPS:
+        return True
+    token = settings.METRICS_TOKEN
+    return bool(token) and hmac.compare_digest(
+        request.headers.get("Authorization", ""), f"Bearer {token}")
+
+
+def metrics_view(request):
+    """Serves the metrics to the monitoring hosts"""
+    if not _is_allowed(request):
+        raise Http404
+    if not is_aggregated():
+        raise ImproperlyConfigured("METRICS_DIR is needed with several WORKERS")
+    return HttpResponse(render(), content_type=CONTENT_TYPE)
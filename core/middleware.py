@@ -0,0 +1,156 @@
+"""Per-request instrumentation
+
+MetricsMiddleware records every request for the /metrics endpoint, see
+core/metrics.py.
+
+The opt-in RequestTimingMiddleware counts the queries of every request and measures
+the time spent in the database, in serializers and in the view. The
+numbers are sent in a Server-Timing header and logged as a JSON line by
+the `core.middleware` logger. Requests slower than REQUEST_TIMING_SLOW_MS
+are logged as warnings together with their SQL.
+
+Enabled by the REQUEST_TIMING setting. Streamed response bodies are
+produced after the middleware returns and are not measured.
+"""
+import json
+import logging
+import threading
+import time
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from rest_framework import serializers
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+_local = threading.local()
+
+
+class RequestTiming:
+    """Measurements of one request, also the database execute wrapper"""
+
+    def __init__(self):
+        self.queries = []
+        self.db = 0.0
+        self.serializer = 0.0
+        self.serializing = False
+        self.view_started = None
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            duration = time.perf_counter() - start
+            self.db += duration
+            self.queries.append((duration, sql))
+
+
+class QueryCounter:
+    """Database execute wrapper counting the queries of a request"""
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+def _timed(data):
+    """Wraps a serializer's `data` property to add its time to the request"""
+
+    def timed_data(serializer):
+        timing = getattr(_local, "timing", None)
+        # nested serializers are already counted by the outermost one
+        if timing is None or timing.serializing:
+            return data.fget(serializer)
+        timing.serializing = True
+        start = time.perf_counter()
+        try:
+            return data.fget(serializer)
+        finally:
+            timing.serializer += time.perf_counter() - start
+            timing.serializing = False
+
+    timed_data.timed = True
+    return property(timed_data)
+
+
+def _instrument_serializers():
+    for cls in (serializers.Serializer, serializers.ListSerializer):
+        if not getattr(cls.data.fget, "timed", False):
+            cls.data = _timed(cls.data)
+
+
+def _ms(seconds):
+    return round(seconds * 1000, 1)
+
+
+class RequestTimingMiddleware:
+    def __init__(self, get_response):
+        if not settings.REQUEST_TIMING:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        _instrument_serializers()
+
+    def __call__(self, request):
+        timing = _local.timing = RequestTiming()
+        start = time.perf_counter()
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(timing))
+                response = self.get_response(request)
+        finally:
+            _local.timing = None
+        end = time.perf_counter()
+
+        metrics = {
+            "db": _ms(timing.db),
+            "serializer": _ms(timing.serializer),
+            "view": _ms(end - timing.view_started) if timing.view_started else 0,
+            "total": _ms(end - start),
+        }
+        response["Server-Timing"] = ", ".join(
+            f"{name};dur={value}" + (
+                f';desc="{len(timing.queries)} queries"' if name == "db" else "")
+            for name, value in metrics.items())
+
+        record = {"method": request.method, "path": request.get_full_path(),
+                  "status": response.status_code,
+                  "queries": len(timing.queries)}
+        record.update({f"{name}_ms": value for name, value in metrics.items()})
+        if metrics["total"] >= settings.REQUEST_TIMING_SLOW_MS:
+            record["sql"] = [{"ms": _ms(duration), "sql": sql}
+                             for duration, sql in timing.queries]
+            logger.warning(json.dumps(record))
+        else:
+            logger.info(json.dumps(record))
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        _local.timing.view_started = time.perf_counter()
+
+
+class MetricsMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        counter = QueryCounter()
+        start = time.perf_counter()
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(counter))
+            response = self.get_response(request)
+        route, action = getattr(request, "metrics_route", ("unmatched", ""))
+        metrics.observe(route, action, response.status_code,
+                        time.perf_counter() - start, counter.count)
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        request.metrics_route = metrics.route_of(view_func, request.method)
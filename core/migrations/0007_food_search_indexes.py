@@ -0,0 +1,53 @@
+# Generated by Django 4.1.10 on 2026-10-17 12:22
+
+import django.contrib.postgres.indexes
+import django.contrib.postgres.search
+from django.contrib.postgres.operations import TrigramExtension
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("core", "0006_alter_diary_food_alter_diary_meal"),
+    ]
+
+    operations = [
+        TrigramExtension(),
+        migrations.AddIndex(
+            model_name="food",
+            index=django.contrib.postgres.indexes.GinIndex(
+                fields=["name"], name="core_food_name_trgm", opclasses=["gin_trgm_ops"]
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="food",
+            index=django.contrib.postgres.indexes.GinIndex(
+                django.contrib.postgres.search.SearchVector("name", config="simple"),
+                name="core_food_name_fts",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="productbrand",
+            index=django.contrib.postgres.indexes.GinIndex(
+                fields=["title"],
+                name="core_prodbrand_title_trgm",
+                opclasses=["gin_trgm_ops"],
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="productcategory",
+            index=django.contrib.postgres.indexes.GinIndex(
+                fields=["title"],
+                name="core_prodcat_title_trgm",
+                opclasses=["gin_trgm_ops"],
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="recipecategory",
+            index=django.contrib.postgres.indexes.GinIndex(
+                fields=["title"],
+                name="core_recipecat_title_trgm",
+                opclasses=["gin_trgm_ops"],
+            ),
+        ),
+    ]
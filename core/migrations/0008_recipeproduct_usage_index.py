@@ -0,0 +1,18 @@
+# Generated by Django 4.1.10 on 2026-10-17 12:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("core", "0007_food_search_indexes"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="recipeproduct",
+            index=models.Index(
+                fields=["product", "recipe"], name="core_recipeproduct_usage"
+            ),
+        ),
+    ]
@@ -0,0 +1,83 @@
+# Generated by Django 4.1.10 on 2026-10-17 12:29
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, Sum
+from django.db.models.functions import TruncDate
+import django.db.models.deletion
+
+TOTALS = ["calc_calories", "calc_proteins", "calc_fats", "calc_carbs", "calc_ethanol"]
+
+
+def fill_totals(apps, schema_editor):
+    Diary = apps.get_model("core", "Diary")
+    DiaryTotal = apps.get_model("core", "DiaryTotal")
+    rows = (
+        Diary.objects.values("user_id", "meal_id", day=TruncDate("added_date"))
+        .annotate(count=Count("id"), **{f"sum_{f}": Sum(f) for f in TOTALS})
+        .order_by()
+    )
+    DiaryTotal.objects.bulk_create(
+        (
+            DiaryTotal(
+                user_id=row["user_id"],
+                meal_id=row["meal_id"],
+                date=row["day"],
+                entries=row["count"],
+                **{f: row[f"sum_{f}"] for f in TOTALS},
+            )
+            for row in rows.iterator()
+        ),
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ("core", "0008_recipeproduct_usage_index"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="DiaryTotal",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("date", models.DateField()),
+                ("entries", models.PositiveIntegerField(default=0)),
+                ("calc_calories", models.FloatField(default=0.0)),
+                ("calc_proteins", models.FloatField(default=0.0)),
+                ("calc_fats", models.FloatField(default=0.0)),
+                ("calc_carbs", models.FloatField(default=0.0)),
+                ("calc_ethanol", models.FloatField(default=0.0)),
+                (
+                    "meal",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE, to="core.meal"
+                    ),
+                ),
+                (
+                    "user",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to=settings.AUTH_USER_MODEL,
+                    ),
+                ),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name="diarytotal",
+            constraint=models.UniqueConstraint(
+                fields=("user", "date", "meal"), name="unique_diary_total"
+            ),
+        ),
+        migrations.RunPython(fill_totals, migrations.RunPython.noop),
+    ]
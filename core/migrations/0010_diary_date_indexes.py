@@ -0,0 +1,25 @@
+# Generated by Django 4.1.10 on 2026-10-17 12:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0009_diary_totals"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="diary",
+            index=models.Index(
+                fields=["user", "added_date", "id"], name="core_diary_user_date"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="diary",
+            index=models.Index(
+                fields=["meal", "added_date", "id"], name="core_diary_meal_date"
+            ),
+        ),
+    ]
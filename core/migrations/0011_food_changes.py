@@ -0,0 +1,35 @@
+# Generated by Django 4.1.10 on 2026-10-17 12:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0010_diary_date_indexes"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="FoodTombstone",
+            fields=[
+                ("id", models.BigIntegerField(primary_key=True, serialize=False)),
+                ("deleted_at", models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name="food",
+            name="updated_at",
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.AddIndex(
+            model_name="food",
+            index=models.Index(fields=["updated_at", "id"], name="core_food_updated"),
+        ),
+        migrations.AddIndex(
+            model_name="foodtombstone",
+            index=models.Index(
+                fields=["deleted_at", "id"], name="core_foodtombstone_deleted"
+            ),
+        ),
+    ]
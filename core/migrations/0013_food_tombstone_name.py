@@ -0,0 +1,18 @@
+# Generated by Django 4.1.10 on 2026-10-17 13:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0012_product_barcodes"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="foodtombstone",
+            name="name",
+            field=models.CharField(default="", max_length=64),
+        ),
+    ]
@@ -1,6 +1,8 @@
 """Provides models for the app"""
 from enum import IntEnum
 
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVector
 from django.db import models
 
 from authentication.models import User
@@ -42,12 +44,77 @@ class Food(models.Model):
     food_type = models.ForeignKey(
         FoodType, null=True, on_delete=models.PROTECT)
     user = models.ForeignKey(User, null=True, on_delete=models.SET_NULL)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:  # pylint: disable=too-few-public-methods
+        """Trigram and full-text indexes used by the ?q= search, the
+        change feed is read in (updated_at, id) order"""
+        indexes = [
+            GinIndex(fields=["name"], name="core_food_name_trgm",
+                     opclasses=["gin_trgm_ops"]),
+            GinIndex(SearchVector("name", config="simple"),
+                     name="core_food_name_fts"),
+            models.Index(fields=["updated_at", "id"], name="core_food_updated"),
+        ]
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        food = super().from_db(db, field_names, values)
+        food._loaded_in_catalog = food.in_catalog()
+        return food
+
+    def in_catalog(self):
+        """Tells whether the food is public or verified, None if the flags
+        are deferred"""
+        flags = [self.__dict__.get(field)
+                 for field in ("is_public", "is_verified")]
+        if None in flags:
+            return None
+        return any(flags)
+
+
+def bulk_create_foods(model, foods, children):
+    """bulk_create() for a Food subclass, which bulk_create() rejects
+
+    The Food rows are created first, then the rows of `model` are inserted
+    the way Model.save() inserts the child row. Returns the ids.
+    """
+    foods = Food.objects.bulk_create(foods)
+    for food, child in zip(foods, children):
+        child.food_ptr_id = food.id
+    model.objects._insert(  # pylint: disable=protected-access
+        children, fields=model._meta.local_concrete_fields)
+    return [food.id for food in foods]
+
+
+class FoodTombstone(models.Model):
+    """Id of a deleted food, reported by the change feed
+
+    The name lets the autocomplete index find the food by a bisection.
+    """
+    id = models.BigIntegerField(primary_key=True)
+    name = models.CharField(max_length=64, default="")
+    deleted_at = models.DateTimeField(auto_now=True)
+
+    class Meta:  # pylint: disable=too-few-public-methods
+        """Read in the same order as the foods"""
+        indexes = [
+            models.Index(fields=["deleted_at", "id"],
+                         name="core_foodtombstone_deleted"),
+        ]
 
 
 class ProductCategory(models.Model):
     """Product categories (dairy, meat etc.)"""
     title = models.CharField(max_length=64)
 
+    class Meta:  # pylint: disable=too-few-public-methods
+        """Category titles are matched by the product search"""
+        indexes = [
+            GinIndex(fields=["title"], name="core_prodcat_title_trgm",
+                     opclasses=["gin_trgm_ops"]),
+        ]
+
     def __str__(self):
         return f"{self.id}: {self.title}"
 
@@ -56,6 +123,13 @@ class ProductBrand(models.Model):
     """Product manufacturers"""
     title = models.CharField(max_length=64)
 
+    class Meta:  # pylint: disable=too-few-public-methods
+        """Brand titles are matched by the product search"""
+        indexes = [
+            GinIndex(fields=["title"], name="core_prodbrand_title_trgm",
+                     opclasses=["gin_trgm_ops"]),
+        ]
+
     def __str__(self):
         return f"{self.id}: {self.title}"
 
@@ -72,10 +146,27 @@ class Product(Food):
     def __str__(self):
         return f"{self.id}: {self.name} ({self.calories} kcal)"
 
+class ProductBarcode(models.Model):
+    """EAN/UPC codes printed on a product, normalized by core.barcodes"""
+    code = models.CharField(max_length=14, unique=True)
+    product = models.ForeignKey(
+        Product, on_delete=models.CASCADE, related_name="barcodes")
+
+    def __str__(self):
+        return f"{self.code} ({self.product_id})"
+
+
 class RecipeCategory(models.Model):
     """Recipe categories (breakfast, lunch etc.)"""
     title = models.CharField(max_length=64)
 
+    class Meta:  # pylint: disable=too-few-public-methods
+        """Category titles are matched by the recipe search"""
+        indexes = [
+            GinIndex(fields=["title"], name="core_recipecat_title_trgm",
+                     opclasses=["gin_trgm_ops"]),
+        ]
+
     def __str__(self):
         return f"{self.id}: {self.title}"
 
@@ -99,6 +190,11 @@ class RecipeProduct(models.Model):
             models.UniqueConstraint(
                 fields=["recipe", "product"], name="unique_recipe_product")
         ]
+        # finds the recipes to recalculate when a product changes
+        indexes = [
+            models.Index(fields=["product", "recipe"],
+                         name="core_recipeproduct_usage"),
+        ]
 
 
 class Diary(models.Model):
@@ -113,3 +209,32 @@ class Diary(models.Model):
     meal = models.ForeignKey(Meal, on_delete=models.PROTECT)
     food = models.ForeignKey(Food, on_delete=models.PROTECT)
     added_date = models.DateTimeField()
+
+    class Meta:  # pylint: disable=too-few-public-methods
+        """Date ranges of a user or a meal are read in page order"""
+        indexes = [
+            models.Index(fields=["user", "added_date", "id"],
+                         name="core_diary_user_date"),
+            models.Index(fields=["meal", "added_date", "id"],
+                         name="core_diary_meal_date"),
+        ]
+
+
+class DiaryTotal(models.Model):
+    """Daily nutrient totals of a user's meal, kept in sync with Diary"""
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    meal = models.ForeignKey(Meal, on_delete=models.CASCADE)
+    date = models.DateField()
+    entries = models.PositiveIntegerField(default=0)
+    calc_calories = models.FloatField(default=0.0)
+    calc_proteins = models.FloatField(default=0.0)
+    calc_fats = models.FloatField(default=0.0)
+    calc_carbs = models.FloatField(default=0.0)
+    calc_ethanol = models.FloatField(default=0.0)
+
+    class Meta:  # pylint: disable=too-few-public-methods
+        """Also serves date range reads of a user's totals"""
+        constraints = [
+            models.UniqueConstraint(
+                fields=["user", "date", "meal"], name="unique_diary_total")
+        ]
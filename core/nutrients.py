@@ -0,0 +1,72 @@
+"""Nutrient calculations shared by serializers and maintenance code"""
+from collections import defaultdict
+
+from django.db import transaction
+from django.utils import timezone
+
+from .models import Food, Recipe, RecipeProduct
+
+NUTRIENTS = ["calories", "proteins", "fats", "carbs", "ethanol"]
+
+
+def calculate_recipe_nutrients(ingredients, mass):
+    """Nutrients of 100 g of a recipe
+
+    `ingredients` yields (nutrients of 100 g of a product, grams used) pairs.
+    """
+    data = dict.fromkeys(NUTRIENTS, 0)
+    for nutrients, grams in ingredients:
+        m = grams / 100
+        for k in data:
+            data[k] += nutrients[k] * m
+    return {k: round(v / (mass / 100), 2) for k, v in data.items()}
+
+
+def propagate_product_changes(product_ids, batch_size=500):
+    """Recalculates the recipes which use any of the given products
+
+    Recipes are found through the (product, recipe) index of RecipeProduct
+    and processed in batches, so a popular product never loads all of its
+    recipes at once. Each batch is atomic; called inside a transaction,
+    as by ProductSerializer.update(), all batches commit together. Returns the ids of the
+    recipes whose nutrients changed.
+    """
+    updated = []
+    last_id = 0
+    while True:
+        recipe_ids = list(
+            RecipeProduct.objects
+            .filter(product_id__in=product_ids, recipe_id__gt=last_id)
+            .order_by("recipe_id")
+            .values_list("recipe_id", flat=True)
+            .distinct()[:batch_size]
+        )
+        if not recipe_ids:
+            return updated
+        last_id = recipe_ids[-1]
+        with transaction.atomic():
+            updated += _recalculate_recipes(recipe_ids)
+
+
+def _recalculate_recipes(recipe_ids):
+    recipes = {
+        row["pk"]: row
+        for row in Recipe.objects.filter(pk__in=recipe_ids).values(
+            "pk", "mass", *NUTRIENTS)
+    }
+    ingredients = defaultdict(list)
+    rows = RecipeProduct.objects.filter(recipe_id__in=recipe_ids).values_list(
+        "recipe_id", "mass", *(f"product__{k}" for k in NUTRIENTS))
+    for recipe_id, grams, *nutrients in rows:
+        ingredients[recipe_id].append((dict(zip(NUTRIENTS, nutrients)), grams))
+
+    changed = []
+    now = timezone.now()
+    for recipe_id, recipe in recipes.items():
+        nutrients = calculate_recipe_nutrients(
+            ingredients[recipe_id], recipe["mass"])
+        if any(nutrients[k] != recipe[k] for k in NUTRIENTS):
+            changed.append(Food(id=recipe_id, updated_at=now, **nutrients))
+    # bulk_update() skips auto_now, the change feed relies on updated_at
+    Food.objects.bulk_update(changed, [*NUTRIENTS, "updated_at"])
+    return [food.id for food in changed]
@@ -0,0 +1,20 @@
+"""Pagination classes for core viewsets"""
+from django.conf import settings
+from rest_framework.pagination import CursorPagination
+
+
+class IdCursorPagination(CursorPagination):
+    """Keyset pagination in insertion order, page N costs the same as page 1
+
+    Clients may pick a smaller or larger page with ?page_size=, up to
+    settings.API_MAX_PAGE_SIZE.
+    """
+    ordering = "id"
+    page_size = settings.API_PAGE_SIZE
+    page_size_query_param = "page_size"
+    max_page_size = settings.API_MAX_PAGE_SIZE
+
+
+class DiaryCursorPagination(IdCursorPagination):
+    """Diary entries are paged by the date they were eaten at"""
+    ordering = ("added_date", "id")
@@ -0,0 +1,104 @@
+"""Incremental maintenance of the DiaryTotal rollup table"""
+from collections import defaultdict
+
+from django.db import connection, transaction
+from django.db.models import Count, F, Sum
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+from .models import Diary, DiaryTotal
+
+TOTALS = ["calc_calories", "calc_proteins", "calc_fats", "calc_carbs",
+          "calc_ethanol"]
+
+
+def add_entries(entries):
+    """Adds diary entries to the totals of their days"""
+    _apply(entries, 1)
+
+
+def remove_entries(entries):
+    """Subtracts diary entries from the totals of their days"""
+    _apply(entries, -1)
+
+
+def _entry_date(entry):
+    added_date = entry.added_date
+    if timezone.is_naive(added_date):
+        added_date = timezone.make_aware(added_date)
+    return timezone.localtime(added_date).date()
+
+
+def _apply(entries, sign):
+    deltas = defaultdict(lambda: dict.fromkeys(["entries", *TOTALS], 0))
+    for entry in entries:
+        delta = deltas[(entry.user_id, _entry_date(entry), entry.meal_id)]
+        delta["entries"] += sign
+        for field in TOTALS:
+            delta[field] += getattr(entry, field) * sign
+    if not deltas:
+        return
+
+    if sign > 0:
+        _upsert(deltas)
+        return
+    with transaction.atomic():
+        for (user_id, date, meal_id), delta in deltas.items():
+            lookup = {"user_id": user_id, "date": date, "meal_id": meal_id}
+            DiaryTotal.objects.filter(**lookup).update(
+                **{field: F(field) + value for field, value in delta.items()})
+            DiaryTotal.objects.filter(**lookup, entries=0).delete()
+
+
+def _upsert(deltas):
+    """Adds to existing rows or creates them, in a single statement"""
+    quote = connection.ops.quote_name
+    table = quote(DiaryTotal._meta.db_table)
+    keys = ["user_id", "date", "meal_id"]
+    values = ["entries", *TOTALS]
+    columns = ", ".join(quote(column) for column in keys + values)
+    row = f"({', '.join(['%s'] * len(keys + values))})"
+    updates = ", ".join(
+        f"{quote(column)} = {table}.{quote(column)} + EXCLUDED.{quote(column)}"
+        for column in values)
+    params = []
+    for key, delta in deltas.items():
+        params += [*key, *(delta[column] for column in values)]
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"INSERT INTO {table} ({columns}) "
+            f"VALUES {', '.join([row] * len(deltas))} "
+            f"ON CONFLICT ({', '.join(quote(key) for key in keys)}) "
+            f"DO UPDATE SET {updates}",
+            params)
+
+
+def rebuild_totals(users=None):
+    """Recomputes the totals from the diary, optionally for some users"""
+    entries = Diary.objects.all()
+    totals = DiaryTotal.objects.all()
+    if users is not None:
+        entries = entries.filter(user__in=users)
+        totals = totals.filter(user__in=users)
+    with transaction.atomic():
+        totals.delete()
+        DiaryTotal.objects.bulk_create(
+            (DiaryTotal(**row) for row in aggregate_entries(entries)),
+            batch_size=1000)
+
+
+def aggregate_entries(entries):
+    """Yields DiaryTotal field values computed from a Diary queryset"""
+    rows = entries.values(
+        "user_id", "meal_id", day=TruncDate("added_date")
+    ).annotate(
+        count=Count("id"), **{f"sum_{field}": Sum(field) for field in TOTALS}
+    ).order_by()
+    for row in rows.iterator():
+        yield {
+            "user_id": row["user_id"],
+            "meal_id": row["meal_id"],
+            "date": row["day"],
+            "entries": row["count"],
+            **{field: row[f"sum_{field}"] for field in TOTALS},
+        }
@@ -1,9 +1,22 @@
 """Serializers for core models"""
-from datetime import datetime
+from copy import copy
 
+from django.conf import settings
+from django.db import models, transaction
+from django.db.models import Prefetch, prefetch_related_objects
+from django.utils import timezone
 from rest_framework import serializers
 
+from . import barcodes
+from . import cache as catalog_cache
+from . import rollups
 from .models import *  # pylint: disable=wildcard-import,unused-wildcard-import
+from .nutrients import (NUTRIENTS, calculate_recipe_nutrients,
+                        propagate_product_changes)
+
+# ingredients of recipes together with their products
+INGREDIENTS = Prefetch(
+    "products", queryset=RecipeProduct.objects.select_related("product"))
 
 
 class MealSerializer(serializers.ModelSerializer):
@@ -44,43 +57,144 @@ class FoodSerializer(serializers.ModelSerializer):
         return food
 
 
-class ProductCategorySerializer(serializers.ModelSerializer):
+class CatalogCacheMixin:
+    """Invalidates the cached data of `cache_resource` on writes
+
+    Searches of `title_resources` match the title, so their list pages are
+    invalidated too when it changes.
+    """
+    cache_resource = None
+    title_resources = []
+
+    def create(self, validated_data):
+        instance = super().create(validated_data)
+        catalog_cache.invalidate(self.cache_resource, instance.pk)
+        return instance
+
+    def update(self, instance, validated_data):
+        title = instance.title
+        instance = super().update(instance, validated_data)
+        catalog_cache.invalidate(self.cache_resource, instance.pk)
+        if instance.title != title:
+            for resource in self.title_resources:
+                catalog_cache.invalidate(resource)
+        return instance
+
+
+class ProductCategorySerializer(CatalogCacheMixin, serializers.ModelSerializer):
+    cache_resource = "product-categories"
+    title_resources = ["products"]
+
     class Meta:
         model = ProductCategory
         fields = "__all__"
         read_only_fields = ["id"]
 
 
-class ProductBrandSerializer(serializers.ModelSerializer):
+class ProductBrandSerializer(CatalogCacheMixin, serializers.ModelSerializer):
+    cache_resource = "product-brands"
+    title_resources = ["products"]
+
     class Meta:
         model = ProductBrand
         fields = "__all__"
         read_only_fields = ["id"]
 
 
+class BarcodeField(serializers.CharField):
+    """An EAN/UPC code, UPC-A is given back as EAN-13"""
+
+    def to_internal_value(self, data):
+        try:
+            return barcodes.normalize(super().to_internal_value(data))
+        except ValueError as error:
+            raise serializers.ValidationError(
+                f"Invalid barcode: {error}") from error
+
+
+class BarcodeListField(serializers.ListField):
+    """Codes of the barcodes of a product"""
+    child = BarcodeField()
+
+    def to_representation(self, data):
+        return [barcode.code for barcode in data.all()]
+
+
 class ProductSerializer(serializers.ModelSerializer):
+    barcodes = BarcodeListField(
+        required=False, max_length=settings.API_MAX_PAGE_SIZE)
+
     class Meta:
         model = Product
-        exclude = ["food_type"]
+        exclude = ["food_type", "updated_at"]
         read_only_fields = ["is_public", "is_verified", "user"]
 
+    def validate_barcodes(self, value):
+        if len(value) != len(set(value)):
+            raise serializers.ValidationError("Duplicate barcodes not allowed")
+        taken = ProductBarcode.objects.filter(code__in=value)
+        if self.instance is not None:
+            taken = taken.exclude(product=self.instance)
+        taken = list(taken.values_list("code", flat=True))
+        if taken:
+            raise serializers.ValidationError(
+                f"Barcodes of other products: {', '.join(taken)}")
+        return value
+
+    def _set_barcodes(self, product, codes):
+        """Replaces the barcodes of the product"""
+        current = set(product.barcodes.values_list("code", flat=True))
+        removed = current.difference(codes)
+        if removed:
+            product.barcodes.filter(code__in=removed).delete()
+        ProductBarcode.objects.bulk_create([
+            ProductBarcode(product=product, code=code)
+            for code in codes if code not in current])
+        # reloaded with the new codes by to_representation()
+        getattr(product, "_prefetched_objects_cache", {}).pop("barcodes", None)
+
     def create(self, validated_data):
         validated_data["food_type"] = FoodType.objects.get(
             id=FoodTypes.PRODUCT)
+        codes = validated_data.pop("barcodes", [])
         food = FoodSerializer(data=validated_data)
         if not food.is_valid(raise_exception=True):
             return None
         product = Product(**validated_data)
         product.food = food
-        product.save()
+        with transaction.atomic(savepoint=False):
+            product.save()
+            ProductBarcode.objects.bulk_create(
+                [ProductBarcode(product=product, code=code) for code in codes])
+        catalog_cache.invalidate("products", product.id)
         return product
 
     def update(self, instance, validated_data):
+        changed = any(k in validated_data and validated_data[k] != getattr(
+            instance, k) for k in NUTRIENTS)
+        # recipes show these fields of their ingredients
+        shown = any(k in validated_data for k in (
+            "name", "calories", "product_category", "product_brand"))
+        codes = validated_data.pop("barcodes", None)
         food = FoodSerializer(
             instance.food_ptr, data=validated_data, partial=True)
-        if food.is_valid(raise_exception=True):
-            food.save()
-        return super().update(instance, validated_data)
+        # the recipes are recalculated along with the product, so they are
+        # never left with the nutrients of the previous version
+        with transaction.atomic(savepoint=False):
+            if food.is_valid(raise_exception=True):
+                food.save()
+            product = super().update(instance, validated_data)
+            if codes is not None:
+                self._set_barcodes(product, codes)
+            recalculated = propagate_product_changes(
+                [product.id]) if changed else []
+        catalog_cache.invalidate("products", product.id)
+        if shown:
+            catalog_cache.invalidate("recipes", *RecipeProduct.objects.filter(
+                product=product).values_list("recipe_id", flat=True))
+        elif recalculated:
+            catalog_cache.invalidate("recipes", *recalculated)
+        return product
 
 
 class ProductStaffSerializer(ProductSerializer):
@@ -94,17 +208,55 @@ class ProductListSerializer(serializers.ModelSerializer):
         fields = ["id", "name", "calories", "product_category", "product_brand"]
 
 
-class RecipeCategorySerializer(serializers.ModelSerializer):
+class RecipeCategorySerializer(CatalogCacheMixin, serializers.ModelSerializer):
+    cache_resource = "recipe-categories"
+    title_resources = ["recipes"]
+
     class Meta:
         model = RecipeCategory
         fields = "__all__"
         read_only_fields = ["id"]
 
 
+class PreloadedPrimaryKeyRelatedField(serializers.PrimaryKeyRelatedField):
+    """Uses objects preloaded by the parent list serializer if possible"""
+    preloaded = None
+
+    def to_internal_value(self, data):
+        if self.preloaded is not None and not isinstance(data, bool):
+            try:
+                return self.preloaded[int(data)]
+            except (KeyError, TypeError, ValueError):
+                pass
+        return super().to_internal_value(data)
+
+
+class RecipeProductListSerializer(serializers.ListSerializer):
+    """Loads the products of all ingredients with a single query"""
+
+    def to_internal_value(self, data):
+        field = self.child.fields["product"]
+        if isinstance(data, list):
+            ids = set()
+            for item in data:
+                try:
+                    ids.add(int(item["product"]))
+                except (KeyError, TypeError, ValueError):
+                    pass
+            field.preloaded = field.get_queryset().in_bulk(ids)
+        try:
+            return super().to_internal_value(data)
+        finally:
+            field.preloaded = None
+
+
 class RecipeProductSerializer(serializers.ModelSerializer):
+    product = PreloadedPrimaryKeyRelatedField(queryset=Product.objects.all())
+
     class Meta:
         model = RecipeProduct
         fields = ["product", "mass"]
+        list_serializer_class = RecipeProductListSerializer
 
     def to_representation(self, instance):
         data = super().to_representation(instance)
@@ -158,20 +310,9 @@ class RecipeSerializer(serializers.ModelSerializer):
         return products
 
     def _calculate_nutrients(self, products, mass):
-        data = {
-            "calories": 0,
-            "proteins": 0,
-            "fats": 0,
-            "carbs": 0,
-            "ethanol": 0,
-        }
-        for product in products:
-            p = product["product"]
-            m = product["mass"] / 100
-            for k in data:
-                data[k] += getattr(p, k) * m
-        data = {k: round(v / (mass / 100), 2) for k, v in data.items()}
-        return data
+        return calculate_recipe_nutrients(
+            (({k: getattr(p["product"], k) for k in NUTRIENTS}, p["mass"])
+             for p in products), mass)
 
     def create(self, validated_data):
         products = self._check_products(validated_data.pop("products"))
@@ -184,13 +325,33 @@ class RecipeSerializer(serializers.ModelSerializer):
         if not food.is_valid(raise_exception=True):
             return None
 
-        recipe = Recipe(**validated_data)
-        recipe.save()
-
-        for product in products:
-            RecipeProduct.objects.create(recipe=recipe, **product)
+        with transaction.atomic():
+            recipe = Recipe(**validated_data)
+            recipe.save()
+            RecipeProduct.objects.bulk_create(
+                [RecipeProduct(recipe=recipe, **p) for p in products])
+        catalog_cache.invalidate("recipes", recipe.id)
         return recipe
 
+    def _update_products(self, instance, current, products):
+        """Applies the difference between the current and new ingredients"""
+        masses = {p["product"].id: p["mass"] for p in products}
+        removed = [pk for pk in current if pk not in masses]
+        added = [RecipeProduct(recipe=instance, **p) for p in products
+                 if p["product"].id not in current]
+        changed = []
+        for pk, entry in current.items():
+            if pk in masses and entry.mass != masses[pk]:
+                entry.mass = masses[pk]
+                changed.append(entry)
+
+        if removed:
+            RecipeProduct.objects.filter(
+                recipe=instance, product_id__in=removed).delete()
+        RecipeProduct.objects.bulk_update(changed, ["mass"])
+        RecipeProduct.objects.bulk_create(added)
+
+    @transaction.atomic
     def update(self, instance, validated_data):
         food = FoodSerializer(
             instance.food_ptr, data=validated_data, partial=True)
@@ -198,20 +359,34 @@ class RecipeSerializer(serializers.ModelSerializer):
             food.save()
 
         mass = validated_data.get("mass", instance.mass)
-        orig_products = [{"product": p.product, "mass": p.mass}
-                         for p in instance.products.all()]
-        products = validated_data.pop("products", orig_products)
-        if mass != instance.mass or products != orig_products:
+        prefetch_related_objects([instance], INGREDIENTS)
+        current = {p.product_id: p for p in instance.products.all()}
+        orig_masses = {pk: p.mass for pk, p in current.items()}
+        products = validated_data.pop("products", None)
+        if products is None:
+            products = [{"product": p.product, "mass": p.mass}
+                        for p in current.values()]
+        else:
             products = self._check_products(products)
+        masses = {p["product"].id: p["mass"] for p in products}
+        if mass != instance.mass or masses != orig_masses:
             nutrients = self._calculate_nutrients(products, mass)
             validated_data |= nutrients
-            # recreate entries if they are changed
-            if products != orig_products:
-                RecipeProduct.objects.filter(recipe=instance).delete()
-                for product in products:
-                    RecipeProduct.objects.create(recipe=instance, **product)
+            if masses != orig_masses:
+                self._update_products(instance, current, products)
+                # reloaded with the new ingredients by to_representation()
+                instance._prefetched_objects_cache = {}  # pylint: disable=protected-access
+
+        recipe = super().update(instance, validated_data)
+        catalog_cache.invalidate("recipes", recipe.id)
+        return recipe
 
-        return super().update(instance, validated_data)
+    def to_representation(self, instance):
+        # writes and UpdateModelMixin drop the prefetched ingredients
+        if "products" in self.fields and "products" not in getattr(
+                instance, "_prefetched_objects_cache", {}):
+            prefetch_related_objects([instance], INGREDIENTS)
+        return super().to_representation(instance)
 
 
 class RecipeStaffSerializer(RecipeSerializer):
@@ -225,10 +400,27 @@ class RecipeListSerializer(serializers.ModelSerializer):
         fields = ["id", "name", "calories", "mass", "recipe_category"]
 
 
+class RecipeExpandedListSerializer(RecipeListSerializer):
+    products = RecipeProductSerializer(many=True, read_only=True)
+
+    class Meta(RecipeListSerializer.Meta):
+        fields = RecipeListSerializer.Meta.fields + ["products"]
+
+
+class DiaryListSerializer(serializers.ListSerializer):
+    """Resolves the foods of a whole page at once"""
+
+    def to_representation(self, data):
+        entries = list(data.all() if isinstance(data, models.Manager) else data)
+        if "food" in self.child.fields:
+            self.child.foods = self.child.resolve_foods(entries)
+        return super().to_representation(entries)
+
+
 class DiarySerializer(serializers.ModelSerializer):
     mass = serializers.FloatField(min_value=0.01, max_value=10000)
     added_date = serializers.DateTimeField(
-        required=False, default=datetime.now())
+        required=False, default=timezone.now)
 
     class Meta:
         model = Diary
@@ -253,8 +445,21 @@ class DiarySerializer(serializers.ModelSerializer):
             "calc_ethanol",
             "user"
         ]
+        list_serializer_class = DiaryListSerializer
+
+    foods = None
 
-    def _calculate_nutrients(self, food, mass):
+    def resolve_foods(self, entries):
+        """Loads products and recipes of the entries, one query per type"""
+        ids = {entry.food_id for entry in entries}
+        foods = {}
+        for key, model in (("product", Product), ("recipe", Recipe)):
+            for food in model.objects.filter(id__in=ids):
+                foods[food.id] = (key, food)
+        return foods
+
+    @staticmethod
+    def _calculate_nutrients(food, mass):
         mass /= 100
         keys = ["calories", "proteins", "fats", "carbs", "ethanol"]
         result = {}
@@ -263,33 +468,122 @@ class DiarySerializer(serializers.ModelSerializer):
         return result
 
     def create(self, validated_data):
-        if validated_data["user"].id != validated_data["meal"].user.id:
+        if validated_data["user"].id != validated_data["meal"].user_id:
             raise serializers.ValidationError({"meal": [
                 "Cannot use other users' meals"
             ]})
-        print(validated_data["user"].id, validated_data["meal"].user.id)
         food = validated_data["food"]
         mass = validated_data["mass"]
         validated_data |= self._calculate_nutrients(food, mass)
         record = Diary(**validated_data)
-        record.save()
+        with transaction.atomic():
+            record.save()
+            rollups.add_entries([record])
 
         return record
 
     def update(self, instance, validated_data):
         mass = validated_data.get("mass", instance.mass)
-        food = validated_data.get("food", instance.food)
-        if mass != instance.mass or food != instance.food:
-            validated_data |= self._calculate_nutrients(instance.food, mass)
-        return super().update(instance, validated_data)
+        food = validated_data.get("food")
+        if mass != instance.mass or (food and food.id != instance.food_id):
+            validated_data |= self._calculate_nutrients(
+                food or instance.food, mass)
+        previous = copy(instance)
+        with transaction.atomic():
+            instance = super().update(instance, validated_data)
+            rollups.remove_entries([previous])
+            rollups.add_entries([instance])
+        return instance
 
     def to_representation(self, instance):
         data = super().to_representation(instance)
-        data.pop("food")
-        if instance.food.food_type.id == FoodTypes.PRODUCT:
-            product = Product.objects.get(id=instance.food.id)
-            data["product"] = ProductListSerializer(product).data
+        # not requested in ?fields=
+        if data.pop("food", None) is None:
+            return data
+        foods = self.foods
+        if foods is None or instance.food_id not in foods:
+            foods = self.resolve_foods([instance])
+        key, food = foods[instance.food_id]
+        if key == "product":
+            data["product"] = ProductListSerializer(food).data
         else:
-            recipe = Recipe.objects.get(id=instance.food.id)
-            data["recipe"] = RecipeListSerializer(recipe).data
+            data["recipe"] = RecipeListSerializer(food).data
         return data
+
+
+class DiaryBulkListSerializer(serializers.ListSerializer):
+    """Validates and inserts a list of diary entries at once"""
+
+    def validate(self, attrs):
+        user = self.context["request"].user
+        foods = Food.objects.in_bulk({entry["food"] for entry in attrs})
+        meals = Meal.objects.in_bulk({entry["meal"] for entry in attrs})
+        errors = []
+        for entry in attrs:
+            error = {}
+            entry["food"] = foods.get(entry["food"])
+            entry["meal"] = meals.get(entry["meal"])
+            if entry["food"] is None:
+                error["food"] = ["Food does not exist"]
+            if entry["meal"] is None:
+                error["meal"] = ["Meal does not exist"]
+            elif entry["meal"].user_id != user.id:
+                error["meal"] = ["Cannot use other users' meals"]
+            errors.append(error)
+        if any(errors):
+            raise serializers.ValidationError(errors)
+        return attrs
+
+    def create(self, validated_data):
+        nutrients = DiarySerializer._calculate_nutrients  # pylint: disable=protected-access
+        records = []
+        for entry in validated_data:
+            entry |= nutrients(entry["food"], entry["mass"])
+            records.append(Diary(**entry))
+        with transaction.atomic():
+            records = Diary.objects.bulk_create(records)
+            rollups.add_entries(records)
+        return records
+
+
+class DiaryBulkSerializer(serializers.Serializer):
+    """A diary entry of a bulk request, foods and meals are given by id"""
+    mass = serializers.FloatField(min_value=0.01, max_value=10000)
+    meal = serializers.IntegerField()
+    food = serializers.IntegerField()
+    added_date = serializers.DateTimeField(
+        required=False, default=timezone.now)
+
+    class Meta:
+        list_serializer_class = DiaryBulkListSerializer
+
+
+class DiarySummaryQuerySerializer(serializers.Serializer):
+    """Query parameters of the diary summary, `end` is exclusive"""
+    period = serializers.ChoiceField(
+        ["day", "week", "month"], required=False, default="day")
+    start = serializers.DateField(required=False)
+    end = serializers.DateField(required=False)
+    group_by = serializers.ChoiceField(["meal"], required=False)
+
+
+class BarcodeBatchSerializer(serializers.Serializer):
+    """Scanned codes resolved by a single request"""
+    codes = serializers.ListField(
+        child=BarcodeField(), allow_empty=False,
+        max_length=settings.API_MAX_PAGE_SIZE)
+
+
+class ChangesQuerySerializer(serializers.Serializer):
+    """Query parameters of the catalog change feed, see core/sync.py"""
+    since = serializers.CharField(required=False)
+    page_size = serializers.IntegerField(
+        min_value=1, max_value=settings.API_MAX_PAGE_SIZE, required=False,
+        default=settings.API_PAGE_SIZE)
+
+
+class AutocompleteQuerySerializer(serializers.Serializer):
+    """Query parameters of the food name autocompletion"""
+    q = serializers.CharField(max_length=64, trim_whitespace=False)
+    limit = serializers.IntegerField(
+        min_value=1, max_value=50, required=False, default=10)
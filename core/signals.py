@@ -0,0 +1,50 @@
+"""Signal handlers of the core app"""
+from django.db.models.signals import post_delete, post_save, pre_delete
+from django.dispatch import receiver
+from django.utils import timezone
+
+from . import cache as catalog_cache
+from .models import (Food, FoodTombstone, Product, ProductBrand,
+                     ProductCategory, Recipe, RecipeCategory)
+
+CACHE_RESOURCES = {Product: "products", Recipe: "recipes"}
+
+
+def _add_tombstone(food):
+    # a food which left the catalog already has one, its time moves on
+    FoodTombstone.objects.bulk_create(
+        [FoodTombstone(id=food.id, name=food.name)], update_conflicts=True,
+        unique_fields=["id"], update_fields=["name", "deleted_at"])
+
+
+@receiver(post_delete, sender=Food)
+def add_food_tombstone(instance, **kwargs):
+    _add_tombstone(instance)
+
+
+@receiver(post_save, sender=Food)
+@receiver(post_save, sender=Product)
+@receiver(post_save, sender=Recipe)
+def hide_food_from_feed(instance, **kwargs):
+    """Foods which are no longer public or verified are reported as
+    deleted by the change feed"""
+    in_catalog = instance.in_catalog()
+    if getattr(instance, "_loaded_in_catalog", None) and in_catalog is False:
+        _add_tombstone(instance)
+    instance._loaded_in_catalog = in_catalog  # pylint: disable=protected-access
+
+
+@receiver(pre_delete, sender=ProductBrand)
+@receiver(pre_delete, sender=ProductCategory)
+@receiver(pre_delete, sender=RecipeCategory)
+def touch_referencing_foods(sender, instance, **kwargs):
+    """SET_NULL clears the references with an UPDATE which bypasses
+    auto_now and the serializers, so the foods are marked as changed and
+    their cached data is dropped here"""
+    for relation in sender._meta.related_objects:  # pylint: disable=protected-access
+        model = relation.related_model
+        ids = list(model.objects.filter(
+            **{relation.field.name: instance}).values_list("id", flat=True))
+        if ids:
+            model.objects.filter(pk__in=ids).update(updated_at=timezone.now())
+            catalog_cache.invalidate(CACHE_RESOURCES[model], *ids)
@@ -0,0 +1,82 @@
+"""Change feed of the food catalog for offline replicas
+
+The feed covers the catalog, the public and verified foods. Every write
+to a food sets its `updated_at`, deletes leave a FoodTombstone, and so do
+foods which leave the catalog. Clients pass the token returned by their previous sync and receive the
+foods written and deleted after it, in (time, id) order and in bounded
+pages. A client without a token starts from the beginning.
+
+Timestamps are taken before the writing transaction commits, so rows
+younger than SYNC_SETTLE_SECONDS are held back until concurrent
+transactions had the time to commit.
+"""
+import base64
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import Food, FoodTombstone, FoodTypes, Product, Recipe
+from .serializers import ProductListSerializer, RecipeListSerializer
+
+
+def encode_token(time, pk):
+    return base64.urlsafe_b64encode(
+        f"{time.isoformat()},{pk}".encode()).decode()
+
+
+def decode_token(token):
+    """(time, id) of a token, raises ValueError if it is malformed"""
+    time, pk = base64.urlsafe_b64decode(token.encode()).decode().split(",")
+    time = datetime.fromisoformat(time)
+    if timezone.is_naive(time):
+        raise ValueError("naive time")
+    return time, int(pk)
+
+
+def _after(queryset, field, since):
+    if since is None:
+        return queryset
+    time, pk = since
+    return queryset.filter(Q(**{f"{field}__gt": time})
+                           | Q(**{field: time, "id__gt": pk}))
+
+
+def changes(since=None, limit=settings.API_PAGE_SIZE):
+    """Up to `limit` changes after the (time, id) position `since`"""
+    until = timezone.now() - timedelta(seconds=settings.SYNC_SETTLE_SECONDS)
+    catalog = Food.objects.filter(Q(is_public=True) | Q(is_verified=True),
+                                  updated_at__lt=until)
+    foods = _after(catalog, "updated_at", since).order_by("updated_at", "id").values_list(
+                       "updated_at", "id", "food_type_id")[:limit + 1]
+    tombstones = _after(FoodTombstone.objects.filter(deleted_at__lt=until),
+                        "deleted_at", since).order_by(
+                            "deleted_at", "id").values_list(
+                                "deleted_at", "id")[:limit + 1]
+    events = sorted([*foods, *((time, pk, None) for time, pk in tombstones)])
+    more = len(events) > limit
+    events = events[:limit]
+
+    # a food which left the catalog and came back has both, the later counts
+    latest = {pk: food_type for _, pk, food_type in events}
+    ids = {FoodTypes.PRODUCT: [], FoodTypes.RECIPE: [], None: []}
+    for pk, food_type in latest.items():
+        ids[food_type].append(pk)
+    last = events[-1][:2] if events else since
+    return {
+        "next": encode_token(*last) if last else None,
+        "more": more,
+        "products": _rows(Product, ProductListSerializer,
+                          ids[FoodTypes.PRODUCT]),
+        "recipes": _rows(Recipe, RecipeListSerializer, ids[FoodTypes.RECIPE]),
+        "deleted": ids[None],
+    }
+
+
+def _rows(model, serializer_class, ids):
+    """Rows like the ones of the list endpoints, see ValuesListMixin"""
+    if not ids:
+        return []
+    return list(model.objects.filter(pk__in=ids).order_by("id").values(
+        *serializer_class.Meta.fields))
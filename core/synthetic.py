@@ -0,0 +1,126 @@
+"""Synthetic data for benchmarks
+
+generate() fills the database with a catalog, users and their diaries.
+The data only depends on the random generator passed in, so a seed
+reproduces the same dataset.
+"""
+from dataclasses import dataclass, field
+from datetime import timedelta
+
+from django.contrib.auth.hashers import make_password
+from django.utils import timezone
+
+from authentication.models import Roles, User
+
+from . import rollups
+from .models import (Diary, Food, FoodTypes, Meal, Product, ProductBrand,
+                     ProductCategory, Recipe, RecipeCategory, RecipeProduct,
+                     bulk_create_foods)
+from .nutrients import NUTRIENTS, calculate_recipe_nutrients
+
+PASSWORD = "benchmark"
+WORDS = ["apple", "bread", "butter", "cheese", "chicken", "chocolate",
+         "coffee", "cream", "egg", "fish", "honey", "juice", "milk", "nut",
+         "oat", "pasta", "pepper", "potato", "rice", "salad", "soup",
+         "tomato", "yogurt"]
+MEALS = ["Breakfast", "Lunch", "Dinner", "Snack"]
+
+
+@dataclass
+class Dataset:
+    """Ids of the generated objects"""
+    users: list = field(default_factory=list)
+    meals: dict = field(default_factory=dict)
+    brands: list = field(default_factory=list)
+    categories: list = field(default_factory=list)
+    recipe_categories: list = field(default_factory=list)
+    products: list = field(default_factory=list)
+    recipes: list = field(default_factory=list)
+    diary: list = field(default_factory=list)
+
+
+def _name(rng, number):
+    return f"{rng.choice(WORDS).title()} {rng.choice(WORDS)} {number}"
+
+
+def _nutrients(rng):
+    return {"calories": round(rng.uniform(10, 600), 1),
+            "proteins": round(rng.uniform(0, 40), 1),
+            "fats": round(rng.uniform(0, 50), 1),
+            "carbs": round(rng.uniform(0, 80), 1),
+            "ethanol": 0.0}
+
+
+def generate(rng, users=10, products=1000, brands=50, categories=20,
+             recipes=200, ingredients=5, diary=500):
+    """Creates the dataset, `diary` is the number of entries per user"""
+    data = Dataset()
+    password = make_password(PASSWORD)
+    data.users = [user.id for user in User.objects.bulk_create(
+        User(username=f"bench{i}", email=f"bench{i}@example.com",
+             password=password,
+             role_id=Roles.MODERATOR if i == 0 else Roles.USER)
+        for i in range(users))]
+    for user_id in data.users:
+        data.meals[user_id] = [meal.id for meal in Meal.objects.bulk_create(
+            Meal(name=name, user_id=user_id) for name in MEALS)]
+
+    data.brands = [brand.id for brand in ProductBrand.objects.bulk_create(
+        ProductBrand(title=f"{rng.choice(WORDS).title()} brand {i}")
+        for i in range(brands))]
+    data.categories = [c.id for c in ProductCategory.objects.bulk_create(
+        ProductCategory(title=f"{rng.choice(WORDS).title()} {i}")
+        for i in range(categories))]
+    data.recipe_categories = [c.id for c in RecipeCategory.objects.bulk_create(
+        RecipeCategory(title=f"{meal} {i}") for i, meal in enumerate(MEALS))]
+
+    nutrients = [_nutrients(rng) for _ in range(products)]
+    data.products = bulk_create_foods(
+        Product,
+        [Food(name=_name(rng, i), food_type_id=FoodTypes.PRODUCT,
+              is_public=True, **values) for i, values in enumerate(nutrients)],
+        [Product(product_brand_id=rng.choice(data.brands),
+                 product_category_id=rng.choice(data.categories),
+                 net_grams=rng.choice([None, 100, 250, 500]))
+         for _ in range(products)])
+    product_nutrients = dict(zip(data.products, nutrients))
+
+    compositions = [
+        {product: rng.randint(10, 300)
+         for product in rng.sample(data.products, min(ingredients, products))}
+        for _ in range(recipes)]
+    masses = [sum(composition.values()) for composition in compositions]
+    nutrients = [
+        calculate_recipe_nutrients(
+            ((product_nutrients[p], grams) for p, grams in composition.items()),
+            mass)
+        for composition, mass in zip(compositions, masses)]
+    data.recipes = bulk_create_foods(
+        Recipe,
+        [Food(name=_name(rng, i), food_type_id=FoodTypes.RECIPE,
+              is_public=True, **values) for i, values in enumerate(nutrients)],
+        [Recipe(directions="Mix everything.", mass=mass,
+                recipe_category_id=rng.choice(data.recipe_categories))
+         for mass in masses])
+    RecipeProduct.objects.bulk_create(
+        RecipeProduct(recipe_id=recipe, product_id=product, mass=grams)
+        for recipe, composition in zip(data.recipes, compositions)
+        for product, grams in composition.items())
+
+    foods = {**product_nutrients, **dict(zip(data.recipes, nutrients))}
+    food_ids = list(foods)
+    now = timezone.now()
+    for user_id in data.users:
+        entries = []
+        for _ in range(diary):
+            food = rng.choice(food_ids)
+            mass = rng.randint(20, 400)
+            entries.append(Diary(
+                user_id=user_id, meal_id=rng.choice(data.meals[user_id]),
+                food_id=food, mass=mass,
+                added_date=now - timedelta(minutes=rng.randint(0, 60 * 24 * 365)),
+                **{f"calc_{k}": foods[food][k] * mass / 100 for k in NUTRIENTS}))
+        Diary.objects.bulk_create(entries)
+        rollups.add_entries(entries)
+        data.diary += [entry.id for entry in entries]
+    return data
@@ -1,3 +1,1029 @@
-from django.test import TestCase
+import json
+import os
+from io import StringIO
+from pathlib import Path
+from random import Random
+from tempfile import TemporaryDirectory
 
-# Create your tests here.
+from django.core.cache import cache
+from django.core.checks import run_checks
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIClient
+
+from authentication.models import Roles, User
+
+from . import autocomplete
+from .models import *  # pylint: disable=wildcard-import,unused-wildcard-import
+from .serializers import ProductListSerializer, RecipeListSerializer
+from .synthetic import generate
+
+
+class DiaryTest(TestCase):
+    fixtures = ["roles", "food_types"]
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user("user", "user@example.com", "pass")
+        self.meal = Meal.objects.create(name="Breakfast", user=self.user)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def _add_entries(self, count):
+        for i in range(count):
+            food_type = FoodTypes.PRODUCT if i % 2 else FoodTypes.RECIPE
+            model = Product if food_type == FoodTypes.PRODUCT else Recipe
+            extra = {} if model is Product else {"directions": "", "mass": 100}
+            food = model.objects.create(
+                name=f"Food {i}", calories=100, proteins=10, fats=10,
+                carbs=10, food_type_id=food_type, **extra)
+            Diary.objects.create(
+                mass=100, calc_calories=100, calc_proteins=10, calc_fats=10,
+                calc_carbs=10, calc_ethanol=0, user=self.user, meal=self.meal,
+                food=food, added_date=timezone.now())
+
+    def _count_list_queries(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get("/api/diary/")
+        self.assertEqual(response.status_code, 200)
+        return len(queries)
+
+    def test_list_query_count_is_constant(self):
+        self._add_entries(2)
+        small = self._count_list_queries()
+        self._add_entries(20)
+        self.assertEqual(self._count_list_queries(), small)
+        self.assertLessEqual(small, 3)
+
+    def test_list_resolves_products_and_recipes(self):
+        self._add_entries(2)
+        data = self.client.get("/api/diary/").json()["results"]
+        self.assertEqual({"product", "recipe"},
+                         {key for entry in data for key in entry
+                          if key in ("product", "recipe")})
+
+    def test_pages_do_not_overlap(self):
+        self._add_entries(5)
+        ids = []
+        url = "/api/diary/?page_size=2"
+        while url:
+            data = self.client.get(url).json()
+            self.assertLessEqual(len(data["results"]), 2)
+            ids += [entry["id"] for entry in data["results"]]
+            url = data["next"]
+        self.assertEqual(sorted(ids), list(
+            Diary.objects.order_by("id").values_list("id", flat=True)))
+
+    def test_bulk_create(self):
+        self._add_entries(2)
+        foods = list(Food.objects.values_list("id", flat=True))
+        other = User.objects.create_user("other", "other@example.com", "pass")
+        other_meal = Meal.objects.create(name="Lunch", user=other)
+
+        entries = [{"mass": 50, "meal": self.meal.id, "food": food_id}
+                   for food_id in foods * 5]
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(
+                "/api/diary/bulk/", entries, format="json")
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(len(response.json()), 10)
+        self.assertEqual(response.json()[0]["calc_calories"], 50)
+        self.assertLessEqual(len(queries), 8)
+
+        entries = [{"mass": 50, "meal": other_meal.id, "food": foods[0]},
+                   {"mass": 50, "meal": self.meal.id, "food": 0}]
+        response = self.client.post("/api/diary/bulk/", entries, format="json")
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(Diary.objects.count(), 12)
+
+    def test_summary_follows_diary_changes(self):
+        product = Product.objects.create(
+            name="Product", calories=200, proteins=10, fats=10, carbs=10,
+            food_type_id=FoodTypes.PRODUCT)
+        dinner = Meal.objects.create(name="Dinner", user=self.user)
+        entries = [
+            {"mass": 100, "meal": self.meal.id, "food": product.id,
+             "added_date": "2024-01-01T08:00:00Z"},
+            {"mass": 50, "meal": dinner.id, "food": product.id,
+             "added_date": "2024-01-01T19:00:00Z"},
+            {"mass": 200, "meal": dinner.id, "food": product.id,
+             "added_date": "2024-01-03T19:00:00Z"},
+        ]
+        created = self.client.post(
+            "/api/diary/bulk/", entries, format="json").json()
+        self.client.patch(f"/api/diary/{created[1]['id']}/",
+                          {"mass": 150}, format="json")
+        self.client.delete(f"/api/diary/{created[2]['id']}/")
+        self.client.post("/api/diary/", {
+            "mass": 10, "meal": dinner.id, "food": product.id,
+            "added_date": "2024-01-08T12:00:00Z"}, format="json")
+
+        days = self.client.get("/api/diary/summary/").json()
+        self.assertEqual(
+            [(d["period"], d["entries"], d["calc_calories"]) for d in days],
+            [("2024-01-01", 2, 500), ("2024-01-08", 1, 20)])
+        weeks = self.client.get("/api/diary/summary/", {
+            "period": "week", "group_by": "meal", "end": "2024-01-08",
+        }).json()
+        self.assertEqual(
+            [(w["period"], w["meal"], w["calc_calories"]) for w in weeks],
+            [("2024-01-01", self.meal.id, 200), ("2024-01-01", dinner.id, 300)])
+
+    def test_export_streams_all_entries(self):
+        self._add_entries(3)
+        response = self.client.get("/api/diary/export/")
+        self.assertEqual(response["Content-Type"], "text/csv")
+        lines = b"".join(response.streaming_content).decode().splitlines()
+        self.assertEqual(len(lines), 4)
+        self.assertTrue(lines[0].startswith("id,added_date,meal,food,"))
+
+        response = self.client.get("/api/diary/export/?format=ndjson")
+        rows = [json.loads(line) for line in
+                b"".join(response.streaming_content).decode().splitlines()]
+        self.assertEqual([row["food_type"] for row in rows],
+                         ["recipe", "product", "recipe"])
+        self.assertEqual(rows[0]["meal"], "Breakfast")
+
+    def test_filter_by_date_range_and_meal(self):
+        product = Product.objects.create(
+            name="Product", calories=100, proteins=10, fats=10, carbs=10,
+            food_type_id=FoodTypes.PRODUCT)
+        dinner = Meal.objects.create(name="Dinner", user=self.user)
+        for day, meal in [(1, self.meal), (2, self.meal), (2, dinner), (3, dinner)]:
+            self.client.post("/api/diary/", {
+                "mass": 100, "meal": meal.id, "food": product.id,
+                "added_date": f"2024-01-0{day}T12:00:00Z"}, format="json")
+
+        day = {"added_date__gte": "2024-01-02", "added_date__lt": "2024-01-03"}
+        data = self.client.get("/api/diary/", day).json()["results"]
+        self.assertEqual(len(data), 2)
+        data = self.client.get("/api/diary/", {**day, "meal": dinner.id}).json()
+        self.assertEqual([e["meal"] for e in data["results"]], [dinner.id])
+
+        entries = Diary.objects.filter(
+            user=self.user, added_date__gte="2024-01-02T00:00:00Z",
+            added_date__lt="2024-01-03T00:00:00Z").order_by("added_date", "id")
+        with connection.cursor() as cursor:
+            cursor.execute("SET LOCAL enable_seqscan = off")
+            plan = entries.explain()
+        self.assertIn("core_diary_user_date", plan)
+
+
+class RecipeNutrientsTest(TestCase):
+    fixtures = ["roles", "food_types"]
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user("user", "user@example.com", "pass")
+        self.user.role_id = Roles.MODERATOR
+        self.user.save()
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.products = [
+            Product.objects.create(
+                name=f"Product {i}", calories=100 * (i + 1), proteins=10,
+                fats=10, carbs=10, food_type_id=FoodTypes.PRODUCT)
+            for i in range(3)
+        ]
+
+    def _create_recipe(self, products):
+        response = self.client.post("/api/recipes/", {
+            "name": "Recipe", "directions": "Mix", "mass": 200,
+            "products": [{"product": p.id, "mass": 100} for p in products],
+        }, format="json")
+        self.assertEqual(response.status_code, 201)
+        return response.json()
+
+    def test_product_change_updates_recipes(self):
+        used = self._create_recipe(self.products[:2])
+        unused = self._create_recipe(self.products[1:])
+        self.assertEqual(used["calories"], 150)
+
+        response = self.client.patch(
+            f"/api/products/{self.products[0].id}/", {"calories": 300},
+            format="json")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Recipe.objects.get(id=used["id"]).calories, 250)
+        self.assertEqual(Recipe.objects.get(id=unused["id"]).calories, 250)
+
+    def test_cached_recipes_get_the_new_nutrients(self):
+        recipe = self._create_recipe(self.products[:2])
+        url = f"/api/recipes/{recipe['id']}/"
+        self.assertEqual(self.client.get(url).json()["calories"], 150)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.patch(f"/api/products/{self.products[0].id}/",
+                              {"calories": 300}, format="json")
+        self.assertEqual(self.client.get(url).json()["calories"], 250)
+
+    def test_cached_ingredients_get_the_new_calories(self):
+        recipe = self._create_recipe(self.products[:2])
+        url = f"/api/recipes/{recipe['id']}/"
+        self.client.get(url)
+        # too little to change the rounded totals of the recipe
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.patch(f"/api/products/{self.products[0].id}/",
+                              {"calories": 100.001}, format="json")
+        data = self.client.get(url).json()
+        self.assertEqual(data["calories"], 150)
+        calories = {item["product"]["id"]: item["product"]["calories"]
+                    for item in data["products"]}
+        self.assertEqual(calories[self.products[0].id], 100.001)
+
+    def _count_queries(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(queries)
+
+    def test_ingredients_are_prefetched(self):
+        self.products += [
+            Product.objects.create(
+                name=f"Extra {i}", calories=50, proteins=5, fats=5, carbs=5,
+                food_type_id=FoodTypes.PRODUCT)
+            for i in range(10)
+        ]
+        small = self._create_recipe(self.products[:2])
+        large = self._create_recipe(self.products)
+
+        self.assertEqual(self._count_queries(f"/api/recipes/{small['id']}/"),
+                         self._count_queries(f"/api/recipes/{large['id']}/"))
+        self.assertLessEqual(
+            self._count_queries(f"/api/recipes/{large['id']}/"), 2)
+
+        data = self.client.get("/api/recipes/?expand=products").json()
+        self.assertEqual([len(r["products"]) for r in data["results"]],
+                         [2, len(self.products)])
+        self.assertLessEqual(
+            self._count_queries("/api/recipes/?expand=products"), 2)
+
+    def test_partial_update_returns_new_ingredients(self):
+        recipe = self._create_recipe(self.products[:2])
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.patch(f"/api/recipes/{recipe['id']}/", {
+                "products": [{"product": p.id, "mass": 50}
+                             for p in self.products[1:]],
+            }, format="json")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            [p["product"]["id"] for p in response.json()["products"]],
+            [p.id for p in self.products[1:]])
+        self.assertLessEqual(len(queries), 12)
+
+
+class FoodSearchTest(TestCase):
+    fixtures = ["roles", "food_types"]
+
+    def setUp(self):
+        user = User.objects.create_user("user", "user@example.com", "pass")
+        self.client = APIClient()
+        self.client.force_authenticate(user)
+        farm = ProductBrand.objects.create(title="Chicken farm")
+        for name, brand in [("Chicken soup", None), ("Tomato soup", farm),
+                            ("Milk", None), ("Bread", None)]:
+            Product.objects.create(
+                name=name, calories=60, proteins=3, fats=3, carbs=5,
+                food_type_id=FoodTypes.PRODUCT, product_brand=brand)
+
+    def _search(self, query):
+        response = self.client.get("/api/products/", {"q": query})
+        return [row["name"] for row in response.json()["results"]]
+
+    def test_typos_find_the_product(self):
+        self.assertEqual(self._search("milc"), ["Milk"])
+        self.assertEqual(self._search("chiken soup")[0], "Chicken soup")
+
+    def test_title_matches_rank_below_name_matches(self):
+        self.assertEqual(self._search("chicken"),
+                         ["Chicken soup", "Tomato soup"])
+
+    def test_names_are_matched_by_the_trigram_index(self):
+        with CaptureQueriesContext(connection) as queries:
+            self._search("chiken")
+        with connection.cursor() as cursor:
+            # the tables are tiny, a scan of the whole table would win
+            # otherwise
+            cursor.execute("SET LOCAL enable_seqscan = off")
+            cursor.execute("SET LOCAL enable_indexscan = off")
+            cursor.execute("EXPLAIN " + queries[-1]["sql"])
+            plan = "\n".join(row[0] for row in cursor.fetchall())
+        self.assertIn("core_food_name_trgm", plan)
+
+
+class CatalogCacheTest(TestCase):
+    fixtures = ["roles", "food_types"]
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user("user", "user@example.com", "pass")
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_reads_are_cached_until_written(self):
+        product = self.client.post("/api/products/", {
+            "name": "Milk", "calories": 60, "proteins": 3, "fats": 3.2,
+            "carbs": 4.7}, format="json").json()
+        url = f"/api/products/{product['id']}/"
+        self.client.get(url)
+        self.client.get("/api/products/")
+        with self.assertNumQueries(0):
+            self.assertEqual(self.client.get(url).json()["name"], "Milk")
+            self.client.get("/api/products/")
+
+        self.client.patch(url, {"name": "Kefir"}, format="json")
+        self.assertEqual(self.client.get(url).json()["name"], "Kefir")
+        self.assertEqual(
+            self.client.get("/api/products/").json()["results"][0]["name"],
+            "Kefir")
+
+    def test_conditional_requests(self):
+        self.user.role_id = Roles.MODERATOR
+        self.user.save()
+        self.client.post("/api/product-categories/", {"title": "Dairy"})
+        etag = self.client.get("/api/product-categories/")["ETag"]
+        with self.assertNumQueries(0):
+            response = self.client.get(
+                "/api/product-categories/", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response["ETag"], etag)
+
+        self.client.post("/api/product-categories/", {"title": "Bakery"})
+        response = self.client.get(
+            "/api/product-categories/", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()), 2)
+
+        milk, bread = [self.client.post("/api/products/", {
+            "name": name, "calories": 60, "proteins": 3, "fats": 3,
+            "carbs": 5}, format="json").json()["id"] for name in ("Milk", "Bread")]
+        etag = self.client.get(f"/api/products/{milk}/")["ETag"]
+        self.client.patch(f"/api/products/{bread}/", {"name": "Rye bread"},
+                          format="json")
+        response = self.client.get(
+            f"/api/products/{milk}/", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.client.patch(f"/api/products/{milk}/", {"name": "Kefir"},
+                          format="json")
+        response = self.client.get(
+            f"/api/products/{milk}/", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["name"], "Kefir")
+
+    def test_deleted_brands_drop_cached_products(self):
+        brand = ProductBrand.objects.create(title="Farm")
+        product = self.client.post("/api/products/", {
+            "name": "Milk", "calories": 60, "proteins": 3, "fats": 3,
+            "carbs": 5, "product_brand": brand.id}, format="json").json()
+        url = f"/api/products/{product['id']}/"
+        self.assertEqual(self.client.get(url).json()["product_brand"], brand.id)
+        self.client.get("/api/products/")
+        brand.delete()
+        self.assertIsNone(self.client.get(url).json()["product_brand"])
+        self.assertIsNone(
+            self.client.get("/api/products/").json()["results"][0]["product_brand"])
+
+    def test_renamed_titles_refresh_cached_searches(self):
+        self.user.role_id = Roles.MODERATOR
+        self.user.save()
+        brand = ProductBrand.objects.create(title="Farm")
+        category = RecipeCategory.objects.create(title="Lunch")
+        products = [self.client.post("/api/products/", {
+            "name": name, "calories": 60, "proteins": 3, "fats": 3,
+            "carbs": 5, "product_brand": brand.id}, format="json").json()["id"]
+            for name in ("Milk", "Oats")]
+        self.client.post("/api/recipes/", {
+            "name": "Porridge", "directions": "Boil", "mass": 100,
+            "recipe_category": category.id,
+            "products": [{"product": pk, "mass": 50} for pk in products],
+        }, format="json")
+        searches = {
+            "/api/products/?q=dairy": (
+                f"/api/product-brands/{brand.id}/", "Dairy", 2),
+            "/api/recipes/?q=breakfast": (
+                f"/api/recipe-categories/{category.id}/", "Breakfast", 1),
+        }
+        for search in searches:
+            self.assertEqual(self.client.get(search).json()["results"], [])
+        for search, (url, title, count) in searches.items():
+            self.client.patch(url, {"title": title}, format="json")
+            self.assertEqual(
+                len(self.client.get(search).json()["results"]), count)
+
+    @override_settings(WORKERS=2)
+    def test_per_process_cache_is_off_with_several_workers(self):
+        product = self.client.post("/api/products/", {
+            "name": "Milk", "calories": 60, "proteins": 3, "fats": 3,
+            "carbs": 5}, format="json").json()
+        url = f"/api/products/{product['id']}/"
+        self.client.get(url)
+        with self.assertNumQueries(2):
+            response = self.client.get(url)
+        self.assertNotIn("ETag", response)
+
+
+@override_settings(REQUEST_TIMING=True, REQUEST_TIMING_SLOW_MS=0)
+class RequestTimingTest(TestCase):
+    fixtures = ["roles", "food_types"]
+
+    def test_timings_are_reported(self):
+        user = User.objects.create_user("user", "user@example.com", "pass")
+        Meal.objects.create(name="Breakfast", user=user)
+        client = APIClient()
+        client.force_authenticate(user)
+        with self.assertLogs("core.middleware", "WARNING") as logs:
+            response = client.get("/api/meals/")
+        self.assertRegex(response["Server-Timing"],
+                         r'^db;dur=[\d.]+;desc="1 queries", serializer;dur=')
+        record = json.loads(logs.records[0].getMessage())
+        self.assertEqual(record["queries"], 1)
+        self.assertIn("core_meal", record["sql"][0]["sql"])
+
+
+@override_settings(METRICS_ALLOWED_IPS=["127.0.0.1"])
+class MetricsTest(TestCase):
+    fixtures = ["roles", "food_types"]
+
+    def setUp(self):
+        self.user = User.objects.create_user("user", "user@example.com", "pass")
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def _sample(self, name):
+        text = self.client.get("/metrics").content.decode()
+        for line in text.splitlines():
+            if line.startswith(name):
+                return float(line.rsplit(" ", 1)[1])
+        return 0
+
+    def test_requests_are_counted_by_route(self):
+        requests = ('caketruth_requests_total'
+                    '{route="meals",action="list",status="200"}')
+        before = self._sample(requests)
+        self.client.get("/api/meals/")
+        self.client.get("/api/meals/")
+        self.assertEqual(self._sample(requests), before + 2)
+        self.assertGreaterEqual(self._sample(
+            'caketruth_request_duration_seconds_bucket'
+            '{route="meals",action="list",le="+Inf"}'), 2)
+
+    @override_settings(METRICS_TOKEN="secret")
+    def test_only_scrapers_are_served(self):
+        client = APIClient(REMOTE_ADDR="203.0.113.5")
+        self.assertEqual(client.get("/metrics").status_code, 404)
+        client.credentials(HTTP_AUTHORIZATION="Bearer wrong")
+        self.assertEqual(client.get("/metrics").status_code, 404)
+        client.credentials(HTTP_AUTHORIZATION="Bearer secret")
+        self.assertEqual(client.get("/metrics").status_code, 200)
+
+    @override_settings(WORKERS=2)
+    def test_several_workers_need_a_directory(self):
+        self.assertEqual([error.id for error in run_checks()], ["core.E001"])
+        with self.assertRaises(ImproperlyConfigured):
+            self.client.get("/metrics")
+        with TemporaryDirectory() as directory, \
+                override_settings(METRICS_DIR=directory):
+            self.assertEqual(run_checks(), [])
+
+    def test_counters_of_other_processes_are_added(self):
+        with TemporaryDirectory() as directory, \
+                override_settings(METRICS_DIR=directory):
+            Path(directory, "metrics-0.json").write_text(json.dumps({
+                "requests": [[["other", "list", "200"], 5]],
+                "queries": [[["other", "list"], 10]],
+                "durations": [],
+            }))
+            self.assertEqual(self._sample(
+                'caketruth_db_queries_total{route="other",action="list"}'), 10)
+
+
+class BenchmarkTest(TestCase):
+    fixtures = ["roles", "food_types"]
+
+    def test_every_endpoint_succeeds(self):
+        with TemporaryDirectory() as directory:
+            output = Path(directory, "report.json")
+            call_command("benchmark", users=2, products=20, brands=3,
+                         categories=3, recipes=5, ingredients=3, diary=10,
+                         repeat=2, output=str(output), stderr=StringIO())
+            report = json.loads(output.read_text())
+        for name, result in report["endpoints"].items():
+            self.assertTrue(all(200 <= status < 300
+                                for status in result["status"]), name)
+        self.assertFalse(Food.objects.exists())
+
+
+class ImportProductsTest(TestCase):
+    fixtures = ["roles", "food_types"]
+
+    def _import(self, name, text, *args):
+        stderr = StringIO()
+        with TemporaryDirectory() as directory:
+            path = Path(directory, name)
+            path.write_text(text, encoding="utf-8")
+            call_command("import_products", str(path), *args,
+                         stdout=StringIO(), stderr=stderr)
+        return stderr.getvalue()
+
+    def test_csv_and_jsonl_dumps(self):
+        farm = ProductBrand.objects.create(title="Farm")
+        errors = self._import("dump.csv", (
+            "name,calories,proteins,fats,carbs,net_grams,brand,category\n"
+            "Milk,60,3,3.2,4.7,1000,Farm,Dairy\n"
+            "Butter,5000,1,82,1,,Farm,Dairy\n"
+            "Kefir,50,3,1,4,,Farm,Dairy\n"), "--public")
+        self.assertIn("dump.csv:3: skipped (calories out of range)", errors)
+        errors = self._import("dump.jsonl", "\n".join([
+            json.dumps({"name": "Oats", "calories": 370, "proteins": 13,
+                        "fats": 7, "carbs": 60, "brand": "Mill",
+                        "category": "Grains"}),
+            "{broken",
+            json.dumps({"name": "Rye", "calories": 340, "proteins": 10,
+                        "fats": 2, "carbs": 70, "brand": "Mill",
+                        "category": "Grains"}),
+        ]))
+        self.assertIn("dump.jsonl:2: skipped", errors)
+
+        self.assertEqual(ProductBrand.objects.count(), 2)
+        self.assertEqual(ProductCategory.objects.count(), 2)
+        products = {product.name: product for product in
+                    Product.objects.select_related("product_brand")}
+        self.assertEqual(sorted(products), ["Kefir", "Milk", "Oats", "Rye"])
+        milk = products["Milk"]
+        self.assertEqual((milk.calories, milk.fats, milk.net_grams),
+                         (60, 3.2, 1000))
+        self.assertEqual(milk.product_brand, farm)
+        self.assertEqual(milk.food_type_id, FoodTypes.PRODUCT)
+        self.assertTrue(milk.is_public)
+        self.assertEqual(products["Oats"].product_brand_id,
+                         products["Rye"].product_brand_id)
+        self.assertFalse(products["Oats"].is_public)
+        self.assertIsNone(products["Oats"].net_grams)
+
+
+class QueryBudgetTest(TestCase):
+    """Every action has a maximum number of queries
+
+    Actions are requested with small and large pages, recipes and
+    batches, which must all make the same number of queries. Raise a
+    budget only together with the change that needs it.
+    """
+    fixtures = ["roles", "food_types"]
+
+    def setUp(self):
+        self.data = generate(Random(1), users=1, products=40, brands=3,
+                             categories=3, recipes=4, ingredients=2, diary=30)
+        self.user = User.objects.get(pk=self.data.users[0])
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.meal = self.data.meals[self.user.id][0]
+        self.product = self.data.products[0]
+
+    def assertBudget(self, budget, method, *requests):
+        """Requests (path, body) pairs, each with an empty cache"""
+        counts = []
+        for path, body in requests:
+            cache.clear()
+            with CaptureQueriesContext(connection) as queries:
+                response = getattr(self.client, method)(path, body, format="json")
+                if response.streaming:
+                    b"".join(response.streaming_content)
+            self.assertLess(response.status_code, 300, f"{method} {path}")
+            counts.append(len(queries))
+        label = f"{method.upper()} {requests[0][0]}"
+        self.assertEqual(len(set(counts)), 1, f"{label} varies: {counts}")
+        self.assertLessEqual(counts[0], budget, f"{label} over budget")
+
+    def _pages(self, path):
+        separator = "&" if "?" in path else "?"
+        return [(f"{path}{separator}page_size={size}", None) for size in (1, 20)]
+
+    def _ingredients(self, count, mass=50):
+        return [{"product": pk, "mass": mass}
+                for pk in self.data.products[10:10 + count]]
+
+    def _recipe_data(self, count, mass=50, **fields):
+        return {"name": "Recipe", "directions": "Mix", "mass": mass * count,
+                "products": self._ingredients(count, mass), **fields}
+
+    def _recipe(self, count):
+        return self.client.post(
+            "/api/recipes/", self._recipe_data(count), format="json").json()["id"]
+
+    def test_meals(self):
+        self.assertBudget(1, "get", *self._pages("/api/meals/"))
+        self.assertBudget(1, "get", (f"/api/meals/{self.meal}/", None))
+        meal = self.client.post("/api/meals/", {"name": "Brunch"}).json()["id"]
+        self.assertBudget(1, "post", ("/api/meals/", {"name": "Supper"}))
+        self.assertBudget(2, "put", (f"/api/meals/{meal}/", {"name": "Lunch"}))
+        self.assertBudget(2, "patch", (f"/api/meals/{meal}/", {"name": "Tea"}))
+        self.assertBudget(4, "delete", (f"/api/meals/{meal}/", None))
+
+    def test_catalog_titles(self):
+        for resource in ("product-categories", "product-brands",
+                         "recipe-categories"):
+            path = f"/api/{resource}/"
+            pk = self.client.post(path, {"title": "Title"}).json()["id"]
+            self.assertBudget(1, "get", (path, None))
+            self.assertBudget(1, "get", (f"{path}{pk}/", None))
+            self.assertBudget(1, "post", (path, {"title": "Other"}))
+            self.assertBudget(2, "put", (f"{path}{pk}/", {"title": "New"}))
+            self.assertBudget(2, "patch", (f"{path}{pk}/", {"title": "Newer"}))
+            self.assertBudget(4, "delete", (f"{path}{pk}/", None))
+
+    def test_products(self):
+        fields = {"name": "Milk", "calories": 60, "proteins": 3, "fats": 3,
+                  "carbs": 5}
+        self.assertBudget(1, "get", *self._pages("/api/products/"))
+        self.assertBudget(1, "get", *self._pages("/api/products/?q=milk"))
+        self.assertBudget(2, "get", (f"/api/products/{self.product}/", None))
+        pk = self.client.post("/api/products/", fields).json()["id"]
+        self.assertBudget(4, "post", ("/api/products/", fields))
+        self.assertBudget(7, "put", (f"/api/products/{self.product}/", fields))
+        self.assertBudget(
+            7, "patch", (f"/api/products/{self.product}/", {"calories": 70}))
+        self.assertBudget(7, "delete", (f"/api/products/{pk}/", None))
+        self.client.patch(f"/api/products/{self.product}/",
+                          {"barcodes": ["4006381333931"]}, format="json")
+        self.assertBudget(3, "get", ("/api/products/barcodes/4006381333931/",
+                                     None))
+        self.assertBudget(2, "post", ("/api/products/barcodes/", {
+            "codes": ["4006381333931"]}), ("/api/products/barcodes/", {
+                "codes": ["4006381333931", "96385074"] * 10}))
+
+    def test_recipes(self):
+        small, large = self._recipe(2), self._recipe(12)
+        self.assertBudget(1, "get", *self._pages("/api/recipes/"))
+        self.assertBudget(
+            2, "get", *self._pages("/api/recipes/?expand=products"))
+        self.assertBudget(2, "get", (f"/api/recipes/{small}/", None),
+                          (f"/api/recipes/{large}/", None))
+        self.assertBudget(8, "post", ("/api/recipes/", self._recipe_data(2)),
+                          ("/api/recipes/", self._recipe_data(12)))
+        for method in ("put", "patch"):
+            self.assertBudget(10, method, *[
+                (f"/api/recipes/{pk}/", self._recipe_data(
+                    n, mass=len(method) * 20, directions="Stir"))
+                for pk, n in ((small, 2), (large, 12))])
+        self.assertBudget(7, "delete", (f"/api/recipes/{small}/", None))
+
+    def test_diary(self):
+        entry = {"mass": 100, "meal": self.meal, "food": self.product}
+        self.assertBudget(3, "get", *self._pages("/api/diary/"))
+        pk = self.data.diary[0]
+        self.assertBudget(3, "get", (f"/api/diary/{pk}/", None))
+        self.assertBudget(8, "post", ("/api/diary/", entry))
+        self.assertBudget(13, "put", (f"/api/diary/{pk}/", entry))
+        self.assertBudget(12, "patch", (f"/api/diary/{pk}/", {"mass": 50}))
+        self.assertBudget(8, "post", ("/api/diary/bulk/", [entry] * 2),
+                          ("/api/diary/bulk/", [entry] * 20))
+        self.assertBudget(1, "get", ("/api/diary/summary/", None),
+                          ("/api/diary/summary/?group_by=meal", None))
+        self.assertBudget(2, "get", ("/api/diary/export/", None))
+        self.assertBudget(8, "delete", (f"/api/diary/{pk}/", None))
+
+    @override_settings(SYNC_SETTLE_SECONDS=0)
+    def test_changes(self):
+        self.assertBudget(4, "get", *self._pages("/api/changes/"))
+
+    @override_settings(AUTOCOMPLETE_SYNC_SECONDS=0)
+    def test_autocomplete(self):
+        autocomplete.reset()
+        self.client.get("/api/autocomplete/?q=a")
+        self.assertBudget(2, "get", ("/api/autocomplete/?q=a", None),
+                          ("/api/autocomplete/?q=chicken&limit=50", None))
+
+
+class ValuesListTest(TestCase):
+    fixtures = ["roles", "food_types"]
+
+    def setUp(self):
+        self.data = generate(Random(2), users=1, products=30, brands=3,
+                             categories=3, recipes=5, ingredients=2, diary=0)
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.get(pk=self.data.users[0]))
+        Product.objects.filter(pk=self.data.products[0]).update(
+            product_brand=None, calories=1e16)
+
+    def _assert_same_output(self, path, serializer_class, queryset):
+        response = self.client.get(path)
+        results = JSONRenderer().render(
+            serializer_class(queryset, many=True).data)
+        self.assertIn(b'"results":' + results, response.content)
+
+    def test_rows_render_like_the_serializer(self):
+        self._assert_same_output("/api/products/?page_size=10",
+                                 ProductListSerializer,
+                                 Product.objects.order_by("id")[:10])
+        self._assert_same_output("/api/recipes/?page_size=10",
+                                 RecipeListSerializer,
+                                 Recipe.objects.order_by("id")[:10])
+
+    def test_search_pages_follow_the_rank(self):
+        ids = []
+        url = "/api/products/?q=milk&page_size=1"
+        while url:
+            data = self.client.get(url).json()
+            self.assertTrue(all("rank" not in row for row in data["results"]))
+            ids += [row["id"] for row in data["results"]]
+            url = data["next"]
+        self.assertGreater(len(ids), 1)
+        self.assertEqual(len(ids), len(set(ids)))
+        self.assertEqual(len(ids), Product.objects.filter(
+            name__trigram_word_similar="milk").count())
+
+
+class SparseFieldsTest(TestCase):
+    fixtures = ["roles", "food_types"]
+
+    def setUp(self):
+        cache.clear()
+        self.data = generate(Random(3), users=1, products=10, brands=2,
+                             categories=2, recipes=3, ingredients=2, diary=10)
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.get(pk=self.data.users[0]))
+
+    def _get(self, path):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(path)
+        self.assertEqual(response.status_code, 200, path)
+        return response.json(), " ".join(q["sql"] for q in queries)
+
+    def test_only_requested_columns_are_selected(self):
+        data, sql = self._get("/api/products/?fields=id,name,calories")
+        self.assertEqual(list(data["results"][0]), ["id", "name", "calories"])
+        self.assertNotIn('"product_brand_id"', sql)
+
+        data, sql = self._get(
+            f"/api/recipes/{self.data.recipes[0]}/?fields=name,mass")
+        self.assertEqual(list(data), ["name", "mass"])
+        self.assertNotIn("core_recipeproduct", sql)
+        self.assertNotIn('"directions"', sql)
+
+    def test_diary_skips_food_resolution(self):
+        data, sql = self._get("/api/diary/?fields=calc_calories,added_date")
+        self.assertEqual(list(data["results"][0]),
+                         ["calc_calories", "added_date"])
+        self.assertNotIn("core_product", sql)
+        self.assertNotIn('"calc_fats"', sql)
+
+        data, sql = self._get("/api/diary/?fields=id,product")
+        entry = data["results"][0]
+        self.assertEqual(list(entry)[0], "id")
+        self.assertTrue({"product", "recipe"} & set(entry))
+
+    def test_cached_details_are_trimmed(self):
+        url = f"/api/products/{self.data.products[0]}/"
+        full = self.client.get(url)
+        with self.assertNumQueries(0):
+            response = self.client.get(f"{url}?fields=name")
+        self.assertEqual(response.json(), {"name": full.json()["name"]})
+        self.assertNotEqual(response["ETag"], full["ETag"])
+
+    def test_unknown_fields_are_rejected(self):
+        response = self.client.get("/api/products/?fields=name,secret")
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json(), {"fields": ["Unknown field: secret"]})
+
+
+@override_settings(SYNC_SETTLE_SECONDS=0)
+class ChangesTest(TestCase):
+    fixtures = ["roles", "food_types"]
+
+    def setUp(self):
+        self.data = generate(Random(4), users=1, products=6, brands=2,
+                             categories=2, recipes=2, ingredients=2, diary=0)
+        self.user = User.objects.get(pk=self.data.users[0])
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def _sync(self, since=None, page_size=None):
+        """Follows the feed until it is drained, returns the merged pages"""
+        merged = {"products": [], "recipes": [], "deleted": []}
+        params = {"page_size": page_size} if page_size else {}
+        while True:
+            if since:
+                params["since"] = since
+            data = self.client.get("/api/changes/", params).json()
+            for key, items in merged.items():
+                items += data[key]
+            since = data["next"]
+            if not data["more"]:
+                return merged, since
+
+    def test_pages_cover_the_catalog(self):
+        changes, _ = self._sync(page_size=3)
+        self.assertEqual([row["id"] for row in changes["products"]],
+                         self.data.products)
+        self.assertEqual(sorted(row["id"] for row in changes["recipes"]),
+                         self.data.recipes)
+        self.assertEqual(set(changes["products"][0]),
+                         {"id", "name", "calories", "product_category",
+                          "product_brand"})
+
+    def test_only_later_changes_are_returned(self):
+        _, since = self._sync()
+        self.assertEqual(self._sync(since)[0],
+                         {"products": [], "recipes": [], "deleted": []})
+
+        product = RecipeProduct.objects.first().product_id
+        unused = Product.objects.filter(recipeproduct=None).first().id
+        self.client.patch(f"/api/products/{product}/", {"calories": 1},
+                          format="json")
+        Product.objects.get(pk=unused).delete()
+        changes, since = self._sync(since)
+        self.assertEqual([row["calories"] for row in changes["products"]], [1])
+        self.assertEqual(changes["deleted"], [unused])
+        # ingredients changed the nutrients of their recipes
+        self.assertEqual(len(changes["recipes"]), Recipe.objects.filter(
+            products__product=product).count())
+
+        brand = Product.objects.exclude(product_brand=None).first()
+        brand.product_brand.delete()
+        changes, _ = self._sync(since)
+        self.assertIn(brand.id, [row["id"] for row in changes["products"]])
+        self.assertTrue(all(row["product_brand"] is None
+                            for row in changes["products"]))
+
+    def test_private_foods_are_not_returned(self):
+        self.client.force_authenticate(None)
+        private = Product.objects.create(
+            name="Private", calories=1, proteins=1, fats=1, carbs=1,
+            food_type_id=FoodTypes.PRODUCT, user=self.user)
+        changes, _ = self._sync()
+        self.assertNotIn(private.id, [row["id"] for row in changes["products"]])
+        self.assertEqual(len(changes["products"]), len(self.data.products))
+
+    def test_foods_leaving_the_catalog_are_deleted(self):
+        _, since = self._sync()
+        product = Product.objects.get(pk=self.data.products[0])
+        product.is_public = False
+        product.save()
+        changes, since = self._sync(since)
+        self.assertEqual(changes["products"], [])
+        self.assertEqual(changes["deleted"], [product.id])
+
+        # published again, and deleted for good later on
+        product.is_public = True
+        product.save()
+        changes, since = self._sync(since)
+        self.assertEqual([row["id"] for row in changes["products"]],
+                         [product.id])
+        self.assertEqual(changes["deleted"], [])
+        RecipeProduct.objects.filter(product=product).delete()
+        product.delete()
+        self.assertEqual(self._sync(since)[0]["deleted"], [product.id])
+
+    def test_invalid_token(self):
+        response = self.client.get("/api/changes/", {"since": "garbage"})
+        self.assertEqual(response.status_code, 400)
+
+
+class BarcodeTest(TestCase):
+    fixtures = ["roles", "food_types"]
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user("user", "user@example.com", "pass")
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def _create(self, name, codes):
+        return self.client.post("/api/products/", {
+            "name": name, "calories": 60, "proteins": 3, "fats": 3,
+            "carbs": 5, "barcodes": codes}, format="json")
+
+    def test_scans_find_the_product(self):
+        # UPC-A codes are stored as EAN-13
+        milk = self._create("Milk", ["4006381333931", "036000291452"]).json()
+        self.assertEqual(milk["barcodes"], ["4006381333931", "0036000291452"])
+        for code in ("036000291452", "0036000291452"):
+            response = self.client.get(f"/api/products/barcodes/{code}/")
+            self.assertEqual(response.json()["id"], milk["id"])
+        with self.assertNumQueries(1):
+            self.client.get("/api/products/barcodes/4006381333931/")
+        self.assertEqual(self.client.get(
+            "/api/products/barcodes/96385074/").status_code, 404)
+        self.assertEqual(self.client.get(
+            "/api/products/barcodes/4006381333932/").status_code, 400)
+
+        response = self.client.post("/api/products/barcodes/", {
+            "codes": ["96385074", "4006381333931"]}, format="json")
+        self.assertEqual([(item["code"], item["product"] and item["product"]["id"])
+                          for item in response.json()],
+                         [("96385074", None), ("4006381333931", milk["id"])])
+
+    def test_codes_belong_to_one_product(self):
+        milk = self._create("Milk", ["4006381333931"]).json()
+        response = self._create("Kefir", ["4006381333931"])
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("barcodes", response.json())
+
+        response = self.client.patch(f"/api/products/{milk['id']}/", {
+            "barcodes": ["96385074"]}, format="json")
+        self.assertEqual(response.json()["barcodes"], ["96385074"])
+        self.assertEqual(self._create(
+            "Kefir", ["4006381333931"]).status_code, 201)
+
+
+@override_settings(AUTOCOMPLETE_SYNC_SECONDS=0)
+class AutocompleteTest(TestCase):
+    fixtures = ["roles", "food_types"]
+
+    def setUp(self):
+        autocomplete.reset()
+        self.user = User.objects.create_user("user", "user@example.com", "pass")
+        self.other = User.objects.create_user("other", "other@example.com", "pass")
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def _food(self, name, **fields):
+        return Product.objects.create(
+            name=name, calories=60, proteins=3, fats=3, carbs=5,
+            food_type_id=FoodTypes.PRODUCT, **fields)
+
+    def _complete(self, prefix):
+        response = self.client.get("/api/autocomplete/", {"q": prefix})
+        self.assertEqual(response.status_code, 200)
+        return [item["name"] for item in response.json()]
+
+    def test_ranking_and_visibility(self):
+        self._food("Milk", is_public=True)
+        popular = self._food("Milk shake", is_public=True)
+        self._food("Milky way", is_verified=True)
+        self._food("Millet", user=self.user)
+        self._food("Mild cheese", user=self.other)
+        self._food("Bread", is_public=True)
+        for _ in range(2):
+            Diary.objects.create(
+                mass=100, calc_calories=60, calc_proteins=3, calc_fats=3,
+                calc_carbs=5, calc_ethanol=0, user=self.user, food=popular,
+                meal=Meal.objects.create(name="Lunch", user=self.user),
+                added_date=timezone.now())
+        self.assertEqual(self._complete("mil"),
+                         ["Milky way", "Milk shake", "Milk", "Millet"])
+        self.assertEqual(self._complete("MILK "), ["Milk shake"])
+
+    def test_writes_are_synced(self):
+        milk = self._food("Milk", is_public=True, user=self.user)
+        self.assertEqual(self._complete("mi"), ["Milk"])
+        self.client.patch(f"/api/products/{milk.id}/", {"name": "Kefir"},
+                          format="json")
+        self._food("Mint", user=self.user)
+        self.assertEqual(self._complete("mi"), ["Mint"])
+        self.assertEqual(self._complete("ke"), ["Kefir"])
+        Product.objects.get(pk=milk.id).delete()
+        # the tombstone's name finds the entry without a scan
+        self.assertEqual(FoodTombstone.objects.get(pk=milk.id).name, "Kefir")
+        self.assertEqual(self._complete("ke"), [])
+
+    @override_settings(AUTOCOMPLETE_SYNC_BATCH=2)
+    def test_syncs_are_read_in_batches(self):
+        autocomplete.get_index()
+        milk = self._food("Milk", is_public=True)
+        for i in range(4):
+            self._food(f"Mint {i}", is_public=True)
+        milk.delete()
+        self._food("Millet", user=self.user)
+        self.assertEqual(sorted(self._complete("mi")),
+                         ["Millet", "Mint 0", "Mint 1", "Mint 2", "Mint 3"])
+
+    def test_forked_processes_start_afresh(self):
+        autocomplete.get_index()
+        with autocomplete._lock:  # pylint: disable=protected-access
+            pid = os.fork()
+            if pid == 0:
+                # pylint: disable-next=protected-access
+                fresh = (autocomplete._index is None
+                         and autocomplete._lock.acquire(blocking=False))
+                os._exit(0 if fresh else 1)  # pylint: disable=protected-access
+        self.assertEqual(os.waitstatus_to_exitcode(os.waitpid(pid, 0)[1]), 0)
+
+    def test_memory_is_reported(self):
+        for i in range(100):
+            self._food(f"Food {i}", is_public=True)
+        stats = autocomplete.get_index().stats()
+        self.assertEqual(stats["names"], 100)
+        # a list slot, a short name and the arrays
+        self.assertLess(stats["bytes_per_million_names"], 200 * 10**6)
+
+
+class PrefixIndexTest(SimpleTestCase):
+    def test_cached_matches_follow_writes(self):
+        rng = Random(5)
+        index = autocomplete.PrefixIndex(
+            (pk, f"Apple {rng.randint(0, 99)}", 1, rng.randint(0, 9))
+            for pk in range(2000))
+        index.search("app", 10)
+        self.assertIn("app", index.cache)
+        index.add(5000, "Apple pie", 2, 100)
+        self.assertEqual(index.search("apple", 1)[0][1], 5000)
+        index.remove(5000, "Apple pie")
+        best = index.search("app", 10)[0]
+        index.remove(best[1], best[2])
+        fresh = autocomplete.PrefixIndex(
+            zip(index.ids, index.names, index.types, index.scores))
+        self.assertEqual(index.search("app", 50), fresh.search("app", 50))
@@ -13,6 +13,8 @@ router.register("recipe-categories", views.RecipeCategoryViewSet,
                 "recipe-categories")
 router.register("recipes", views.RecipeViewSet, "recipes")
 router.register("diary", views.DiaryViewSet, "diary")
+router.register("changes", views.ChangesViewSet, "changes")
+router.register("autocomplete", views.AutocompleteViewSet, "autocomplete")
 
 urlpatterns = [
     path("", include(router.urls)),
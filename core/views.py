@@ -1,21 +1,217 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import F, Sum
+from django.db.models.functions import TruncMonth, TruncWeek
+from django.http import StreamingHttpResponse
 from django.shortcuts import get_object_or_404
-from rest_framework import status
-from rest_framework.exceptions import PermissionDenied
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
+from django_filters.rest_framework import DjangoFilterBackend
+from rest_framework import serializers, status
+from rest_framework.decorators import action
+from rest_framework.exceptions import NotFound, PermissionDenied, ValidationError
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
-from rest_framework.viewsets import ModelViewSet
+from rest_framework.viewsets import GenericViewSet, ModelViewSet
 
 from authentication.models import Roles
 from authentication.permissions import (IsOwner, IsStaffOrOwnerOrReadOnly,
                                         IsStaffOrReadOnly)
 
+from . import autocomplete, barcodes
+from . import cache as catalog_cache
+from . import rollups, sync
+from .export import (CSVRenderer, NDJSONRenderer, export_rows, stream_csv,
+                     stream_ndjson)
+from .filters import FoodSearchFilter
 from .models import *  # pylint: disable=wildcard-import,unused-wildcard-import
+from .pagination import DiaryCursorPagination, IdCursorPagination
 from .serializers import *  # pylint: disable=wildcard-import,unused-wildcard-import
 
 
-class MealViewSet(ModelViewSet):
+class SparseFieldsMixin:
+    """Limits list and detail responses to the fields of ?fields=id,name
+
+    The other fields are dropped from the serializer, their columns from
+    the SELECT and their relations from the prefetches. Views may accept
+    other names for serializer fields in `sparse_field_aliases`.
+    """
+    sparse_field_param = "fields"
+    sparse_field_aliases = {}
+    _sparse_sources = {}
+
+    @classmethod
+    def _get_sources(cls, serializer_class):
+        if serializer_class not in cls._sparse_sources:
+            cls._sparse_sources[serializer_class] = {
+                name: field.source
+                for name, field in serializer_class().fields.items()}
+        return cls._sparse_sources[serializer_class]
+
+    def get_sparse_fields(self):
+        """Requested serializer fields in their serializer order, None if
+        the whole representation is wanted"""
+        value = self.request.query_params.get(self.sparse_field_param, "")
+        names = {name for name in value.split(",") if name}
+        if self.action not in ("list", "retrieve") or not names:
+            return None
+        sources = self._get_sources(self.get_serializer_class())
+        unknown = {name for name in names
+                   if self.sparse_field_aliases.get(name, name) not in sources}
+        if unknown:
+            raise ValidationError({self.sparse_field_param: [
+                f"Unknown field: {name}" for name in sorted(unknown)]})
+        names = {self.sparse_field_aliases.get(name, name) for name in names}
+        return [name for name in sources if name in names]
+
+    def filter_queryset(self, queryset):
+        queryset = super().filter_queryset(queryset)
+        fields = self.get_sparse_fields()
+        if fields is None:
+            return queryset
+        sources = self._get_sources(self.get_serializer_class())
+        names = {sources[name] for name in fields}
+        if self.action == "list" and self.paginator is not None:
+            ordering = self.paginator.get_ordering(self.request, queryset, self)
+            names.update(name.lstrip("-") for name in ordering)
+        model = queryset.model
+        columns = names & {field.name for field in model._meta.concrete_fields}
+        lookups = [
+            lookup for lookup in queryset._prefetch_related_lookups  # pylint: disable=protected-access
+            if getattr(lookup, "prefetch_to", lookup).split("__")[0] in names]
+        return queryset.only(*columns).prefetch_related(None).prefetch_related(
+            *lookups)
+
+    def get_serializer(self, *args, **kwargs):
+        serializer = super().get_serializer(*args, **kwargs)
+        fields = self.get_sparse_fields()
+        if fields is not None:
+            child = getattr(serializer, "child", serializer)
+            for name in set(child.fields) - set(fields):
+                del child.fields[name]
+        return serializer
+
+
+class CachedCatalogMixin(SparseFieldsMixin):
+    """Serves list and detail reads from the catalog cache
+
+    Writes through the serializers invalidate the cached data, see
+    core/cache.py. Views set `cache_resource` to their router basename.
+
+    Responses carry an ETag and Last-Modified derived from the cached
+    version, and conditional requests are answered with 304 before the
+    queryset or the serializer is touched. Sparse details are cut from the
+    cached representation, or read without being cached if it is missing.
+    Reads bypass the cache where it is turned off, see core/cache.py.
+    """
+    cache_resource = None
+
+    def _not_modified(self, request, version):
+        """Returns a 304 response if the client has this version, sets
+        the validators for the response otherwise"""
+        tag = f"{version:x}-{request.accepted_renderer.format}"
+        fields = self.get_sparse_fields()
+        if fields is not None:
+            tag += "-" + ",".join(fields)
+        self.etag = quote_etag(tag)
+        self.last_modified = version // 10**9
+        return get_conditional_response(
+            request, etag=self.etag, last_modified=self.last_modified)
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(request, response, *args, **kwargs)
+        if getattr(self, "etag", None) and response.status_code in (200, 304):
+            response["ETag"] = self.etag
+            response["Last-Modified"] = http_date(self.last_modified)
+        return response
+
+    def retrieve(self, request, *args, **kwargs):
+        if not catalog_cache.enabled():
+            return super().retrieve(request, *args, **kwargs)
+        pk = kwargs[self.lookup_url_kwarg or self.lookup_field]
+        version = catalog_cache.get_version(self.cache_resource, pk)
+        response = self._not_modified(request, version)
+        if response is not None:
+            return response
+        fields = self.get_sparse_fields()
+        data = catalog_cache.get_detail(self.cache_resource, pk, version)
+        if data is None:
+            data = super().retrieve(request, *args, **kwargs).data
+            if fields is None:
+                catalog_cache.set_detail(self.cache_resource, pk, version, data)
+        elif fields is not None:
+            data = {name: data[name] for name in fields}
+        return Response(data)
+
+    def list(self, request, *args, **kwargs):
+        if not catalog_cache.enabled():
+            return super().list(request, *args, **kwargs)
+        version = catalog_cache.get_version(self.cache_resource)
+        response = self._not_modified(request, version)
+        if response is not None:
+            return response
+        key = catalog_cache.list_key(self.cache_resource, request, version)
+        data = cache.get(key)
+        if data is None:
+            data = super().list(request, *args, **kwargs).data
+            cache.set(key, data)
+        return Response(data)
+
+    def perform_destroy(self, instance):
+        pk = instance.pk
+        super().perform_destroy(instance)
+        catalog_cache.invalidate(self.cache_resource, pk)
+
+
+class ValuesListMixin(SparseFieldsMixin):
+    """Lists rows read with .values() when the list serializer allows it
+
+    A serializer whose fields all render the stored column value as is
+    (numbers, strings, booleans, foreign keys as ids) produces exactly the
+    rows of `.values(*fields)`. Such lists skip model instances and the
+    per-field serializer calls, the rendered JSON stays the same.
+    """
+    VALUES_FIELDS = (serializers.BooleanField, serializers.CharField,
+                     serializers.FloatField, serializers.IntegerField,
+                     serializers.PrimaryKeyRelatedField)
+    _values_fields = {}
+
+    @classmethod
+    def _get_values_fields(cls, serializer_class):
+        if serializer_class not in cls._values_fields:
+            fields = serializer_class().fields
+            flat = all(type(field) in cls.VALUES_FIELDS and field.source == name
+                       for name, field in fields.items())
+            cls._values_fields[serializer_class] = list(fields) if flat else None
+        return cls._values_fields[serializer_class]
+
+    def list(self, request, *args, **kwargs):
+        fields = self._get_values_fields(self.get_serializer_class())
+        if fields is None:
+            return super().list(request, *args, **kwargs)
+        fields = self.get_sparse_fields() or fields
+        queryset = self.filter_queryset(self.get_queryset())
+        # the paginator needs the ordering, e.g. the search rank annotation
+        ordering = []
+        if self.paginator is not None:
+            ordering = [name.lstrip("-") for name in
+                        self.paginator.get_ordering(request, queryset, self)]
+        extra = [name for name in dict.fromkeys(
+            [*queryset.query.annotations, *ordering]) if name not in fields]
+        rows = queryset.values(*fields, *extra)
+        page = self.paginate_queryset(rows)
+        data = [{name: row[name] for name in fields}
+                for row in (rows if page is None else page)]
+        if page is None:
+            return Response(data)
+        return self.get_paginated_response(data)
+
+
+class MealViewSet(SparseFieldsMixin, ModelViewSet):
     serializer_class = MealSerializer
     permission_classes = [IsAuthenticated, IsOwner]
+    pagination_class = IdCursorPagination
 
     def get_queryset(self):
         return Meal.objects.filter(user=self.request.user)
@@ -24,27 +220,38 @@ class MealViewSet(ModelViewSet):
         serializer.save(user=self.request.user)
 
 
-class ProductCategoryViewSet(ModelViewSet):
+class ProductCategoryViewSet(CachedCatalogMixin, ModelViewSet):
+    cache_resource = "product-categories"
     queryset = ProductCategory.objects.all()
     serializer_class = ProductCategorySerializer
     permission_classes = [IsStaffOrReadOnly]
 
 
-class ProductBrandViewSet(ModelViewSet):
+class ProductBrandViewSet(CachedCatalogMixin, ModelViewSet):
+    cache_resource = "product-brands"
     queryset = ProductBrand.objects.all()
     serializer_class = ProductBrandSerializer
     permission_classes = [IsStaffOrReadOnly]
 
 
-# TODO search
-class ProductViewSet(ModelViewSet):
-    queryset = Product.objects.all()
+class ProductViewSet(CachedCatalogMixin, ValuesListMixin, ModelViewSet):
+    cache_resource = "products"
     permission_classes = [IsStaffOrOwnerOrReadOnly]
+    pagination_class = IdCursorPagination
+    filter_backends = [DjangoFilterBackend, FoodSearchFilter]
+    search_title_fields = ["product_brand", "product_category"]
+
+    def get_queryset(self):
+        queryset = Product.objects.all()
+        # writes reload the barcodes after saving anyway
+        if self.action in ("retrieve", "barcode", "barcodes_batch"):
+            queryset = queryset.prefetch_related("barcodes")
+        return queryset
 
     def get_serializer_class(self, request=None):
         if self.action == "list":
             return ProductListSerializer
-        if request and request.user.role.id != Roles.USER:
+        if request and request.user.role_id != Roles.USER:
             return ProductStaffSerializer
         return ProductSerializer
 
@@ -53,7 +260,7 @@ class ProductViewSet(ModelViewSet):
 
     def partial_update(self, request, *args, pk=None, **kwargs):
         product = get_object_or_404(Product, id=pk)
-        if request.user.role.id == Roles.USER and request.user.id != product.user.id:
+        if request.user.role_id == Roles.USER and request.user.id != product.user_id:
             raise PermissionDenied("Cannot change other users' products")
         serializer = self.get_serializer_class(request)(
             product, data=request.data, partial=True)
@@ -61,22 +268,71 @@ class ProductViewSet(ModelViewSet):
             serializer.save(user=self.request.user)
             return Response(serializer.data, status=status.HTTP_200_OK)
 
+    @action(detail=False, url_path=r"barcodes/(?P<code>[^/.]+)")
+    def barcode(self, request, code=None):
+        """The product of a scanned code, read like its detail
+
+        The code is found by a probe of the unique index, the product
+        itself usually comes from the catalog cache.
+        """
+        try:
+            code = barcodes.normalize(code)
+        except ValueError as error:
+            raise ValidationError({"code": [f"Invalid barcode: {error}"]}) from error
+        pk = ProductBarcode.objects.filter(code=code).values_list(
+            "product_id", flat=True).first()
+        if pk is None:
+            raise NotFound("No product has this barcode")
+        self.kwargs[self.lookup_field] = pk
+        return self.retrieve(request, pk=pk)
+
+    @action(detail=False, methods=["post"], url_path="barcodes")
+    def barcodes_batch(self, request):
+        """Products of a list of scanned codes, in the order of the codes,
+        null for unknown ones"""
+        params = BarcodeBatchSerializer(data=request.data)
+        params.is_valid(raise_exception=True)
+        codes = params.validated_data["codes"]
+        products = self.get_queryset().filter(barcodes__code__in=codes).distinct()
+        found = {}
+        for product in products:
+            data = ProductSerializer(product).data
+            for barcode in data["barcodes"]:
+                found[barcode] = data
+        return Response([{"code": code, "product": found.get(code)}
+                         for code in codes])
 
-class RecipeCategoryViewSet(ModelViewSet):
+
+class RecipeCategoryViewSet(CachedCatalogMixin, ModelViewSet):
+    cache_resource = "recipe-categories"
     queryset = RecipeCategory.objects.all()
     serializer_class = RecipeCategorySerializer
     permission_classes = [IsStaffOrReadOnly]
 
 
-# TODO search
-class RecipeViewSet(ModelViewSet):
-    queryset = Recipe.objects.all()
+class RecipeViewSet(CachedCatalogMixin, ValuesListMixin, ModelViewSet):
+    cache_resource = "recipes"
     permission_classes = [IsStaffOrOwnerOrReadOnly]
+    pagination_class = IdCursorPagination
+    filter_backends = [DjangoFilterBackend, FoodSearchFilter]
+    search_title_fields = ["recipe_category"]
+
+    def _expand_products(self):
+        expand = self.request.query_params.get("expand", "")
+        return "products" in expand.split(",")
+
+    def get_queryset(self):
+        queryset = Recipe.objects.all()
+        if self.action != "list" or self._expand_products():
+            queryset = queryset.prefetch_related(INGREDIENTS)
+        return queryset
 
     def get_serializer_class(self, request=None):
         if self.action == "list":
+            if self._expand_products():
+                return RecipeExpandedListSerializer
             return RecipeListSerializer
-        if request and request.user.role.id != Roles.USER:
+        if request and request.user.role_id != Roles.USER:
             return RecipeStaffSerializer
         return RecipeSerializer
 
@@ -84,8 +340,8 @@ class RecipeViewSet(ModelViewSet):
         serializer.save(user=self.request.user)
 
     def partial_update(self, request, *args, pk=None, **kwargs):
-        recipe = get_object_or_404(Recipe, id=pk)
-        if request.user.role.id == Roles.USER and request.user.id != recipe.user.id:
+        recipe = get_object_or_404(self.get_queryset(), id=pk)
+        if request.user.role_id == Roles.USER and request.user.id != recipe.user_id:
             raise PermissionDenied("Cannot change other users' recipes")
         serializer = self.get_serializer_class(request)(
             recipe, data=request.data, partial=True)
@@ -94,12 +350,115 @@ class RecipeViewSet(ModelViewSet):
             return Response(serializer.data, status=status.HTTP_200_OK)
 
 
-class DiaryViewSet(ModelViewSet):
+class DiaryViewSet(SparseFieldsMixin, ModelViewSet):
     serializer_class = DiarySerializer
     permission_classes = [IsAuthenticated, IsOwner]
+    pagination_class = DiaryCursorPagination
+    filterset_fields = {"added_date": ["gte", "lt"], "meal": ["exact"]}
+    # entries show their food as either of them
+    sparse_field_aliases = {"product": "food", "recipe": "food"}
 
     def get_queryset(self):
         return Diary.objects.filter(user=self.request.user)
 
     def perform_create(self, serializer):
         serializer.save(user=self.request.user)
+
+    @action(detail=False, methods=["post"])
+    def bulk(self, request):
+        """Adds a list of entries, e.g. every item of a meal"""
+        serializer = DiaryBulkSerializer(
+            data=request.data, many=True, allow_empty=False,
+            max_length=settings.API_MAX_PAGE_SIZE,
+            context=self.get_serializer_context())
+        serializer.is_valid(raise_exception=True)
+        records = serializer.save(user=request.user)
+        return Response(DiarySerializer(records, many=True).data,
+                        status=status.HTTP_201_CREATED)
+
+    def perform_destroy(self, instance):
+        with transaction.atomic():
+            rollups.remove_entries([instance])
+            instance.delete()
+
+    @action(detail=False, pagination_class=None,
+            renderer_classes=[CSVRenderer, NDJSONRenderer])
+    def export(self, request):
+        """Streams the diary as CSV or NDJSON (?format=ndjson)"""
+        rows = export_rows(self.filter_queryset(self.get_queryset()))
+        if request.accepted_renderer.format == "ndjson":
+            content, content_type = stream_ndjson(rows), NDJSONRenderer.media_type
+        else:
+            content, content_type = stream_csv(rows), CSVRenderer.media_type
+        response = StreamingHttpResponse(content, content_type=content_type)
+        response["Content-Disposition"] = (
+            f'attachment; filename="diary.{request.accepted_renderer.format}"')
+        return response
+
+    @action(detail=False)
+    def summary(self, request):
+        """Nutrient totals per day, week or month, read from DiaryTotal"""
+        params = DiarySummaryQuerySerializer(data=request.query_params)
+        params.is_valid(raise_exception=True)
+        params = params.validated_data
+
+        totals = DiaryTotal.objects.filter(user=request.user)
+        if "start" in params:
+            totals = totals.filter(date__gte=params["start"])
+        if "end" in params:
+            totals = totals.filter(date__lt=params["end"])
+        truncate = {"week": TruncWeek, "month": TruncMonth}.get(
+            params["period"])
+        totals = totals.annotate(
+            period=truncate("date") if truncate else F("date"))
+        keys = ["period", "meal"] if "group_by" in params else ["period"]
+        rows = totals.values(*keys).annotate(
+            total_entries=Sum("entries"),
+            **{f"total_{field}": Sum(field) for field in rollups.TOTALS}
+        ).order_by(*keys)
+
+        data = []
+        for row in rows:
+            item = {key: row[key] for key in keys}
+            item["entries"] = row["total_entries"]
+            for field in rollups.TOTALS:
+                item[field] = round(row[f"total_{field}"], 2)
+            data.append(item)
+        return Response(data)
+
+
+class ChangesViewSet(GenericViewSet):
+    """Catalog changes for offline replicas (?since=<token>), see core/sync.py
+
+    Public and verified products and recipes are given as in their lists,
+    deleted foods and foods which became private by id.
+    The returned `next` token is passed as `since` by the following sync,
+    `more` tells that further changes are waiting.
+    """
+
+    def list(self, request):
+        params = ChangesQuerySerializer(data=request.query_params)
+        params.is_valid(raise_exception=True)
+        params = params.validated_data
+        since = None
+        if "since" in params:
+            try:
+                since = sync.decode_token(params["since"])
+            except ValueError as error:
+                raise ValidationError({"since": ["Invalid token"]}) from error
+        return Response(sync.changes(since, params["page_size"]))
+
+
+class AutocompleteViewSet(GenericViewSet):
+    """Foods whose names start with ?q=, see core/autocomplete.py
+
+    Public and verified foods are completed for everyone, other foods for
+    their owners. Verified and often eaten foods come first.
+    """
+
+    def list(self, request):
+        params = AutocompleteQuerySerializer(data=request.query_params)
+        params.is_valid(raise_exception=True)
+        params = params.validated_data
+        return Response(autocomplete.get_index().complete(
+            params["q"], request.user.id, params["limit"]))